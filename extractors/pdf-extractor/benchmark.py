@@ -0,0 +1,375 @@
+"""
+Offline benchmark of the PDF extractor. It generates synthetic PDFs (text only, vector heavy, scanned, mixed and
+slide decks with repeated pages, from a single page up to 1000 pages, and optionally scans of well over 100 MB),
+runs the processing of the extractor on every one of them with the uploads to Clowder stubbed out and reports the
+throughput, peak memory use and where the time went as JSON.
+
+Run it in the extractor image, so the Ghostscript, qpdf, ... that get measured are the ones we deploy:
+    docker run --rm -v $PWD:/results <image> python benchmark.py --output /results/benchmark.json
+Use --large to include the big scans, --upload-latency to pretend uploads take time and --setting to try other
+settings of the extractor, e.g. --setting sprite_sheet_pages=25
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+from PIL import Image
+from pypdf import PdfWriter
+from pypdf.generic import (
+    DecodedStreamObject,
+    DictionaryObject,
+    EncodedStreamObject,
+    NameObject,
+    NumberObject,
+)
+
+import pdf_extractor
+
+# Documents that are generated: name, kind of pages and number of pages
+DOCUMENTS = [
+    ("text-1", "text", 1),
+    ("text-100", "text", 100),
+    ("text-1000", "text", 1000),
+    ("vector-50", "vector", 50),
+    ("scanned-20", "scanned", 20),
+    ("mixed-300", "mixed", 300),
+    ("deck-120", "deck", 120),
+]
+# Documents that take a while to generate and process, only with --large
+LARGE_DOCUMENTS = [
+    ("scanned-large-24", "scanned-large", 24),
+]
+
+# Size (in pixels) of the images of the scanned pages: a 100 dpi and a 300 dpi scan of a US letter page
+SCANNED_IMAGE_SIZE = (850, 1100)
+SCANNED_LARGE_IMAGE_SIZE = (2550, 3300)
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et "
+    "dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea "
+    "commodo consequat"
+).split()
+
+
+def text_page(rng):
+    """Content stream of a page with 60 lines of text"""
+    lines = [b"BT /F1 10 Tf 12 TL 50 760 Td"]
+    for _ in range(60):
+        line = " ".join(rng.choice(WORDS) for _ in range(14))
+        lines.append(b"(" + line.encode("ascii") + b") Tj T*")
+    lines.append(b"ET")
+    return b"\n".join(lines)
+
+
+def vector_page(rng, paths=3000):
+    """Content stream of a page with lots of stroked and filled paths"""
+    operations = [b"0.5 w"]
+    for _ in range(paths):
+        points = [(rng.uniform(0, 612), rng.uniform(0, 792)) for _ in range(4)]
+        operations.append(
+            (
+                "%.3f %.3f %.3f rg %.1f %.1f m %.1f %.1f %.1f %.1f %.1f %.1f c h %s"
+                % (
+                    (rng.random(), rng.random(), rng.random())
+                    + points[0]
+                    + points[1]
+                    + points[2]
+                    + points[3]
+                    + (rng.choice(["S", "f", "B"]),)
+                )
+            ).encode("ascii")
+        )
+    return b"\n".join(operations)
+
+
+def scanned_image(rng, size):
+    """JPEG of a page sized image of noise (which, like a real scan, doesn't compress much)"""
+    image = Image.frombytes("L", size, rng.randbytes(size[0] * size[1]))
+    image = image.convert("RGB")
+    jpeg_file = tempfile.SpooledTemporaryFile()
+    image.save(jpeg_file, "JPEG", quality=85)
+    jpeg_file.seek(0)
+    return jpeg_file.read()
+
+
+def add_page(writer, content, resources):
+    page = writer.add_blank_page(612, 792)
+    page[NameObject("/Resources")] = resources
+    stream = DecodedStreamObject()
+    stream.set_data(content)
+    page[NameObject("/Contents")] = writer._add_object(stream.flate_encode())
+
+
+def make_pdf(pdf_path, kind, num_pages, seed=0):
+    """Generate a PDF with num_pages pages of the given kind"""
+    rng = random.Random(seed)
+    writer = PdfWriter()
+    font_resources = DictionaryObject(
+        {
+            NameObject("/Font"): DictionaryObject(
+                {
+                    NameObject("/F1"): DictionaryObject(
+                        {
+                            NameObject("/Type"): NameObject("/Font"),
+                            NameObject("/Subtype"): NameObject("/Type1"),
+                            NameObject("/BaseFont"): NameObject("/Helvetica"),
+                        }
+                    )
+                }
+            )
+        }
+    )
+
+    def add_scanned_page(size):
+        image = EncodedStreamObject()
+        image._data = scanned_image(rng, size)
+        image.update(
+            {
+                NameObject("/Type"): NameObject("/XObject"),
+                NameObject("/Subtype"): NameObject("/Image"),
+                NameObject("/Width"): NumberObject(size[0]),
+                NameObject("/Height"): NumberObject(size[1]),
+                NameObject("/ColorSpace"): NameObject("/DeviceRGB"),
+                NameObject("/BitsPerComponent"): NumberObject(8),
+                NameObject("/Filter"): NameObject("/DCTDecode"),
+            }
+        )
+        resources = DictionaryObject(
+            {
+                NameObject("/XObject"): DictionaryObject(
+                    {NameObject("/Im0"): writer._add_object(image)}
+                )
+            }
+        )
+        add_page(writer, b"q 612 0 0 792 0 0 cm /Im0 Do Q", resources)
+
+    for page_num in range(num_pages):
+        page_kind = kind
+        if kind == "mixed":
+            page_kind = ["text", "text", "vector", "scanned"][page_num % 4]
+        if page_kind == "text":
+            add_page(writer, text_page(rng), font_resources)
+        elif page_kind == "vector":
+            add_page(writer, vector_page(rng), DictionaryObject())
+        elif page_kind == "scanned":
+            add_scanned_page(SCANNED_IMAGE_SIZE)
+        elif page_kind == "scanned-large":
+            add_scanned_page(SCANNED_LARGE_IMAGE_SIZE)
+        elif page_kind == "deck":
+            # Animation builds export as the same slide a couple of times, with a blank separator now and then
+            slide = page_num // 3
+            if slide % 10 == 9:
+                add_page(writer, b"", DictionaryObject())
+            else:
+                add_page(writer, text_page(random.Random(slide)), font_resources)
+        else:
+            raise ValueError("Unknown kind of page %s" % page_kind)
+
+    with open(pdf_path, "wb") as pdf_file:
+        writer.write(pdf_file)
+
+
+class BenchmarkExtractor(pdf_extractor.PDFExtractor):
+    """The PDF extractor without a connection to Clowder"""
+
+    def __init__(self):
+        # Skip the setup of pyclowder (command line arguments, connecting to RabbitMQ)
+        pass
+
+    def get_metadata(self, content, resource_type, resource_id, server=None):
+        return content
+
+
+class StatsHandler(logging.Handler):
+    """Pick up the stats the extractor logs for every document"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.stats = []
+
+    def emit(self, record):
+        message = record.getMessage()
+        if message.startswith("Extraction stats: "):
+            self.stats.append(json.loads(message[len("Extraction stats: ") :]))
+
+
+def run_document(pdf_path, settings, upload_latency, results):
+    """
+    Process a PDF like the extractor does (in a process of its own, so the peak memory use of the process and of
+    its children is that of this document only) and put the stats the extractor logged on the results queue.
+    """
+    # Don't let a cache of the previews skew the results
+    pdf_extractor.CACHE_DIR = ""
+
+    def upload_preview(connector, host, key, fileid, previewfile, previewmetadata):
+        time.sleep(upload_latency)
+        return str(uuid.uuid4())
+
+    def upload_metadata(connector, host, key, fileid, metadata):
+        time.sleep(upload_latency)
+
+    pdf_extractor.upload_preview = upload_preview
+    pdf_extractor.upload_metadata = upload_metadata
+
+    stats_handler = StatsHandler()
+    logging.getLogger(pdf_extractor.__name__).addHandler(stats_handler)
+    BenchmarkExtractor().process_message(
+        None,
+        "http://localhost:9000/",
+        "",
+        {
+            "id": os.path.basename(pdf_path),
+            "name": os.path.basename(pdf_path),
+            "local_paths": [pdf_path],
+        },
+        {"parameters": settings},
+    )
+    results.put(stats_handler.stats[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument(
+        "--output", help="file to write the results (JSON) to, default stdout"
+    )
+    parser.add_argument(
+        "--workdir",
+        help="directory for the generated PDFs (they are kept, and reused by later runs), default a temporary "
+        "directory",
+    )
+    parser.add_argument(
+        "--large", action="store_true", help="include the documents of over 100 MB"
+    )
+    parser.add_argument(
+        "--only", action="append", help="only run the document with this name"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="number of runs of every document"
+    )
+    parser.add_argument(
+        "--upload-latency",
+        type=float,
+        default=0.0,
+        help="seconds every (stubbed) upload takes",
+    )
+    parser.add_argument(
+        "--setting",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="override a setting of the extractor (the value is JSON, or a string)",
+    )
+    parser.add_argument("--verbose", action="store_true", help="show the debug log")
+    args = parser.parse_args()
+
+    # The stats of the extractor are picked up at INFO level, but only shown with --verbose
+    log_handler = logging.StreamHandler(sys.stderr)
+    log_handler.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    log_handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING,
+        handlers=[log_handler],
+    )
+    logging.getLogger(pdf_extractor.__name__).setLevel(
+        logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    settings = {}
+    for setting in args.setting:
+        key, value = setting.split("=", 1)
+        if key not in pdf_extractor.default_settings:
+            parser.error("unknown setting %s" % key)
+        try:
+            settings[key] = json.loads(value)
+        except ValueError:
+            settings[key] = value
+
+    documents = DOCUMENTS + (LARGE_DOCUMENTS if args.large else [])
+    if args.only:
+        documents = [document for document in documents if document[0] in args.only]
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="pdf-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+
+    results = []
+    for name, kind, num_pages in documents:
+        pdf_path = os.path.join(workdir, "%s.pdf" % name)
+        if not os.path.exists(pdf_path):
+            print("Generating %s" % name, file=sys.stderr)
+            make_pdf(pdf_path, kind, num_pages)
+        file_mb = os.stat(pdf_path).st_size / (1024 * 1024)
+
+        for run in range(args.repeat):
+            result_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=run_document,
+                args=(pdf_path, settings, args.upload_latency, result_queue),
+            )
+            process.start()
+            while True:
+                try:
+                    stats = result_queue.get(timeout=1)
+                    break
+                except queue.Empty:
+                    if not process.is_alive():
+                        sys.exit("Processing %s failed" % name)
+            process.join()
+
+            seconds = max(stats["seconds"], 1e-6)
+            results.append(
+                {
+                    "document": name,
+                    "kind": kind,
+                    "run": run + 1,
+                    "pages": num_pages,
+                    "file_mb": round(file_mb, 3),
+                    "seconds": stats["seconds"],
+                    "pages_per_second": round(num_pages / seconds, 3),
+                    "mb_per_second": round(file_mb / seconds, 3),
+                    "peak_rss_mb": stats["peak_rss_mb"],
+                    "peak_child_rss_mb": stats["peak_child_rss_mb"],
+                    "uploads": stats["uploads"],
+                    "stages": stats["stages"],
+                }
+            )
+            print(
+                "%-20s run %d: %8.2f s %8.2f pages/s %8.2f MB/s, peak RSS %8.2f MB (children %8.2f MB)"
+                % (
+                    name,
+                    run + 1,
+                    stats["seconds"],
+                    num_pages / seconds,
+                    file_mb / seconds,
+                    stats["peak_rss_mb"],
+                    stats["peak_child_rss_mb"],
+                ),
+                file=sys.stderr,
+            )
+
+    report = {
+        "cpus": pdf_extractor.available_cpus(),
+        "settings": dict(pdf_extractor.default_settings, **settings),
+        "upload_latency": args.upload_latency,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,1666 @@
+import collections
+import contextlib
+import gc
+import hashlib
+import io
+import itertools
+import json
 import logging
+import math
+import mmap
+import multiprocessing
 import os
+import queue
+import re
+import resource
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
 
+from PIL import Image
 from pyclowder.extractors import Extractor
 from pyclowder.files import upload_preview
 from pyclowder.files import upload_metadata
-from pypdf import PdfReader, PdfWriter
+from pypdf import PageObject, PdfReader, PdfWriter
+from pypdf.errors import PdfReadError
+from pypdf.generic import (
+    ArrayObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    StreamObject,
+)
 from pathvalidate import sanitize_filename
 
 MAX_PDF_MB = 10
+# Extra Ghostscript (pdfwrite) options of the compression profiles for PDFs larger than MAX_PDF_MB
+PDF_COMPRESSION_PROFILES = {
+    "lossless": [],
+    "ebook": ["-dPDFSETTINGS=/ebook"],
+}
+# Rough fraction of their size that images, embedded fonts and everything else keep in a lossless Ghostscript
+# rewrite: images pass through as they are, fonts get subset and the content streams get (re)compressed
+LOSSLESS_IMAGE_RATIO = 1.0
+LOSSLESS_FONT_RATIO = 0.6
+LOSSLESS_OTHER_RATIO = 0.5
+# Relative margin around MAX_PDF_MB within which the estimate for lossless compression is too close to call, so
+# both profiles are run (concurrently)
+PLANNER_UNCERTAINTY = 0.25
+# Maximum number of pages that are rasterized by a single Ghostscript run (the document is only parsed once per
+# range, while keeping the ranges small enough to spread over the workers)
+PAGES_PER_GS_RUN = 50
+
+# Cache of previews, keyed by the contents of the file and the settings (disabled if no directory is given), and
+# the size (in MB) it may grow to before the least recently used previews are evicted
+CACHE_DIR = os.getenv("PDF_PREVIEW_CACHE_DIR", "")
+CACHE_MAX_MB = int(os.getenv("PDF_PREVIEW_CACHE_MAX_MB", "2048"))
+
+# Pages that only draw a single image (scans) get their preview straight from that image, when it is encoded with
+# one of these filters
+SCANNED_IMAGE_FILTERS = [
+    None,
+    "/DCTDecode",
+    "/JPXDecode",
+    "/JBIG2Decode",
+    "/FlateDecode",
+    "/CCITTFaxDecode",
+    "/LZWDecode",
+    "/RunLengthDecode",
+]
+# Content stream operators that can appear on a scanned page besides drawing the image (graphics state only)
+SCANNED_PAGE_OPERATORS = [
+    b"q",
+    b"Q",
+    b"cm",
+    b"gs",
+    b"w",
+    b"J",
+    b"j",
+    b"M",
+    b"d",
+    b"ri",
+    b"i",
+]
+# Minimum fraction of the page (in both directions) the image of a scanned page has to cover
+SCANNED_IMAGE_COVERAGE = 0.95
+
+# Largest width or height of a WebP image, which limits the size of the sprite sheets
+WEBP_MAX_DIMENSION = 16383
+
+# Page attributes that pages inherit from their parents in the page tree
+INHERITABLE_PAGE_ATTRIBUTES = ["/Resources", "/MediaBox", "/CropBox", "/Rotate"]
+# Page attributes that determine what a page looks like, pages that have the same (by content) look the same
+FINGERPRINT_PAGE_ATTRIBUTES = [
+    "/Contents",
+    "/Resources",
+    "/MediaBox",
+    "/CropBox",
+    "/Rotate",
+    "/UserUnit",
+    "/Group",
+]
+# Keys that are left out of the fingerprint of a dictionary (they don't change what it looks like, or point back
+# up the page tree)
+FINGERPRINT_IGNORED_KEYS = ["/Length", "/Parent"]
+# End of the dictionary of a stream object and the start of its data
+STREAM_KEYWORD_PATTERN = re.compile(rb">>\s*stream(?:\r\n|\r|\n)")
+# How far into an object we look for the start of the data of a stream
+STREAM_DICTIONARY_MAX_BYTES = 1 << 16
+# How much of the data of a stream is read at a time to fingerprint it
+FINGERPRINT_CHUNK_BYTES = 1 << 20
+
+# Settings that can be overridden per file through the "parameters" of a (manual) submission
+default_settings = {
+    # Number of processes used to render page previews (0 means use all CPUs available to the container)
+    "preview_workers": 0,
+    # Width (in pixels) of the page previews, pages are rendered straight at this width
+    "preview_width": 512,
+    # WebP quality (0-100) of the page previews
+    "preview_quality": 75,
+    # Number of threads uploading previews while the pages are still being rendered
+    "upload_threads": 4,
+    # Maximum number of rendered previews waiting for an upload thread
+    "upload_queue_size": 16,
+    # Maximum number of pages that get a preview image (0 means all pages), the rest of the document is skipped (it
+    # is still in the preview PDF). All pages render inside the same message, so without a cap a book of thousands
+    # of pages holds up a worker (and the queue behind it) for as long as it takes.
+    "max_preview_pages": 500,
+    # Number of pages for which the previews and metadata are published before we render the rest of the document
+    "first_batch_pages": 10,
+    # Linearize the preview PDF ("fast web view"), so viewers can show the first page before the whole file is in
+    "linearize_preview": True,
+    # Extract the text of the pages (for the pages that get a preview)
+    "extract_text": True,
+    # Maximum number of terms in the term to page index of the text (the terms that best tell the pages apart)
+    "text_index_max_terms": 2000,
+    # Maximum number of pages listed for a term in the index, the first pages it occurs on (0 means all pages)
+    "text_index_max_pages": 50,
+    # Add the timings and memory use of the extraction (which are always logged) to the metadata
+    "stats_in_metadata": False,
+    # Pack the page previews in sprite sheets of this many pages, rather than uploading one image per page (0 means
+    # one image per page)
+    "sprite_sheet_pages": 0,
+    # Number of page previews next to each other in a row of a sprite sheet
+    "sprite_sheet_columns": 5,
+    # Width (in pixels) of the pages in the low resolution strip of all pages that comes with the sprite sheets (0
+    # means no strip)
+    "strip_width": 64,
+    # Render pages that look exactly the same as an earlier page (same content and resources) only once, they share
+    # the preview of the first one
+    "dedupe_pages": True,
+}
+# Settings that don't change the previews, so they are not part of the cache key
+CACHE_IGNORED_SETTINGS = [
+    "preview_workers",
+    "upload_threads",
+    "upload_queue_size",
+    "first_batch_pages",
+    "stats_in_metadata",
+]
+# Single files that can be part of a cache entry
+CACHE_FILE_KEYS = ["preview_pdf", "page_text"]
+# Lists of files (one per page, pages that share an image list the same file) that can be part of a cache entry
+CACHE_FILE_LIST_KEYS = ["preview_images", "strip_images"]
+
+# What counts as a term for the index of the text of a document
+TEXT_TERM_PATTERN = re.compile(r"\w{3,}")
+# Words that are too common to be worth a place in the index of the text (English and French, the languages of
+# most of our documents)
+TEXT_STOPWORDS = set("""
+    about after again also and any are because been before being between both but can could did does doing down
+    during each few for from further had has have having her here hers him his how into its just more most not now
+    off once only other our ours out over own same she should some such than that the their theirs them then there
+    these they this those through too under until very was were what when where which while who whom why will with
+    would you your yours
+    aux avec car ces cet cette comme dans des donc dont elle elles est été être fait ils les leur leurs mais même nos
+    notre nous par pas peut plus pour qui que quel quelle sans ses son sont sous sur tout tous une vos votre vous
+    """.split())
+# Terms that occur on more than this fraction of the pages don't help finding a page (in documents of at least
+# TEXT_INDEX_MIN_PAGES pages)
+TEXT_INDEX_MAX_PAGE_FRACTION = 0.5
+TEXT_INDEX_MIN_PAGES = 4
+
+
+def available_cpus():
+    """
+    Count the CPUs we are allowed to use. This respects both the CPU affinity of the process and the CPU quota of
+    the container (cgroup v2 or v1), which multiprocessing.cpu_count() ignores.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = multiprocessing.cpu_count()
+
+    quota = None
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max", "r") as cpu_max:
+            cpu_quota, cpu_period = cpu_max.read().split()[:2]
+        if cpu_quota != "max":
+            quota = int(cpu_quota) / int(cpu_period)
+    except (IOError, ValueError):
+        try:
+            # cgroup v1: a quota of -1 means no limit
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "r") as cfs_quota:
+                cpu_quota = int(cfs_quota.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us", "r") as cfs_period:
+                cpu_period = int(cfs_period.read())
+            if cpu_quota > 0 and cpu_period > 0:
+                quota = cpu_quota / cpu_period
+        except (IOError, ValueError):
+            pass
+
+    if quota:
+        cpus = min(cpus, max(1, int(quota)))
+
+    return cpus
+
+
+class StageTimings:
+    """
+    Add up the time (in seconds) spent in the stages of processing a document. Stages that run in parallel (in the
+    render workers, on the upload threads) add up the time of all of them, so the stages can add up to more than
+    the time it took to process the document.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        # Peak resident memory of the largest child process (Ghostscript, qpdf, the render workers) of the document
+        self.child_peak_mb = 0.0
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager timing a stage"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start)
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def add_child_peak(self, peak_mb):
+        with self.lock:
+            self.child_peak_mb = max(self.child_peak_mb, peak_mb)
+
+    def update(self, seconds, child_peak_mb=0.0):
+        """Add the timings of another StageTimings (its seconds dict and child_peak_mb)"""
+        for name, stage_seconds in seconds.items():
+            self.add(name, stage_seconds)
+        self.add_child_peak(child_peak_mb)
+
+    def as_dict(self):
+        with self.lock:
+            return dict(
+                (name, round(stage_seconds, 3))
+                for name, stage_seconds in self.seconds.items()
+            )
+
+
+def page_preview_dpi(page, preview_width):
+    """
+    Work out the resolution at which a page comes out of Ghostscript at (close to) the preview width, based on the
+    width of its MediaBox (in points, 1/72 inch) and taking the rotation of the page into account.
+    """
+    width = float(page.mediabox.width)
+    if page.rotation % 180 == 90:
+        width = float(page.mediabox.height)
+    if width <= 0:
+        # Broken MediaBox, fall back to the PDF default page size (US letter)
+        width = 612.0
+    return round(preview_width * 72.0 / width, 3)
+
+
+def split_page_ranges(page_nums, page_modes, workers, block_pages=0):
+    """
+    Split the pages to render into (page numbers, mode) ranges, enough of them to keep all workers busy but never
+    more than PAGES_PER_GS_RUN pages per range. Since Ghostscript uses one resolution per run, the pages are first
+    grouped by how they render (mode) over the whole document and only then split into ranges, so pages of
+    alternating sizes (or scans in between text pages) don't break the document up into ranges of a page or two.
+    The pages of a range don't have to be consecutive (Ghostscript picks them out with -sPageList), but are in order.
+
+    :param page_nums: list of the page numbers of the pages to render
+    :param page_modes: list with how each of these pages gets rendered (e.g. its rendering resolution)
+    :param workers: number of workers that will render the ranges
+    :param block_pages: if given, the ranges are the blocks of this many pages (counted from the first page of the
+    document) instead, or the part of them that is to be rendered in one mode (e.g. the pages that go in one sprite
+    sheet)
+    :return: list of the ranges, in order of their first page
+    """
+    num_pages = len(page_nums)
+    # A couple of ranges per worker evens out pages that are slower to render than others
+    range_size = int(math.ceil(num_pages / float(2 * workers)))
+    range_size = max(1, min(range_size, PAGES_PER_GS_RUN))
+    if block_pages:
+        range_size = block_pages
+
+    groups = collections.defaultdict(list)
+    for page_num, mode in zip(page_nums, page_modes):
+        block = (page_num - 1) // block_pages if block_pages else 0
+        groups[(mode, block)].append(page_num)
+
+    page_ranges = []
+    for (mode, _), group in groups.items():
+        for start in range(0, len(group), range_size):
+            page_ranges.append((group[start : start + range_size], mode))
+    page_ranges.sort(key=lambda page_range: page_range[0][0])
+    return page_ranges
+
+
+def read_ppm_images(stream):
+    """
+    Read a stream of concatenated binary PPM (P6) images, as Ghostscript writes them for a multipage render to
+    stdout, and yield them one at a time as PIL images.
+    """
+
+    def read_token():
+        token = b""
+        while True:
+            char = stream.read(1)
+            if not char:
+                return token
+            if char == b"#":
+                # Comment until the end of the line
+                stream.readline()
+                continue
+            if char.isspace():
+                if token:
+                    return token
+                continue
+            token += char
+
+    while True:
+        magic = read_token()
+        if not magic:
+            return
+        if magic != b"P6":
+            raise ValueError(
+                "Unexpected image format in Ghostscript output: %r" % magic
+            )
+        width, height, maxval = int(read_token()), int(read_token()), int(read_token())
+        if maxval > 255:
+            raise ValueError("Unsupported PPM maximum value %d" % maxval)
+        # read_token() consumed the single whitespace character after the header
+        data = stream.read(width * height * 3)
+        if len(data) != width * height * 3:
+            raise ValueError("Truncated image in Ghostscript output")
+        yield Image.frombuffer("RGB", (width, height), data, "raw", "RGB", 0, 1)
+
+
+def ghostscript_page_selection(page_nums):
+    """Ghostscript options to render only the given pages (1-based, in order)"""
+    if page_nums[-1] - page_nums[0] + 1 == len(page_nums):
+        return ["-dFirstPage=%d" % page_nums[0], "-dLastPage=%d" % page_nums[-1]]
+    page_list = []
+    for _, run in itertools.groupby(
+        enumerate(page_nums), lambda item: item[1] - item[0]
+    ):
+        run = [page_num for _, page_num in run]
+        if len(run) == 1:
+            page_list.append("%d" % run[0])
+        else:
+            page_list.append("%d-%d" % (run[0], run[-1]))
+    return ["-sPageList=%s" % ",".join(page_list)]
+
+
+def render_pages(file_path, page_nums, dpi):
+    """
+    Rasterize pages of a PDF with a single Ghostscript run. The pages are streamed through a pipe rather than
+    written to disk.
+
+    :param file_path: path to the PDF
+    :param page_nums: list of the page numbers (1-based, in order) of the pages to render
+    :param dpi: resolution to render at
+    :return: generator of PIL images, in page order
+    """
+    gs_process = subprocess.Popen(
+        [
+            "gs",
+            "-sDEVICE=ppmraw",
+            "-r%s" % dpi,
+            # Antialiasing, we are rendering straight at the preview size so we don't get it from downscaling
+            "-dTextAlphaBits=4",
+            "-dGraphicsAlphaBits=4",
+        ]
+        + ghostscript_page_selection(page_nums)
+        + [
+            "-dNOPAUSE",
+            "-dQUIET",
+            "-dBATCH",
+            # Keep any messages from the interpreter out of the image stream
+            "-sstdout=%stderr",
+            "-sOutputFile=-",
+            file_path,
+        ],
+        stdout=subprocess.PIPE,
+    )
+    try:
+        for image in read_ppm_images(gs_process.stdout):
+            yield image
+    finally:
+        gs_process.stdout.close()
+        returncode = gs_process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, gs_process.args)
+
+
+def multiply_matrices(m, n):
+    """Multiply two PDF transformation matrices [a b c d e f] (m x n)"""
+    return [
+        m[0] * n[0] + m[1] * n[2],
+        m[0] * n[1] + m[1] * n[3],
+        m[2] * n[0] + m[3] * n[2],
+        m[2] * n[1] + m[3] * n[3],
+        m[4] * n[0] + m[5] * n[2] + n[4],
+        m[4] * n[1] + m[5] * n[3] + n[5],
+    ]
+
+
+def scanned_image_name(page):
+    """
+    Check whether a page is a scan, i.e. all it does is draw a single (upright) image covering the whole page. This
+    only looks at the dictionary of the image, not at its data.
+
+    :return: the name of the image XObject if the page is a scan, otherwise None
+    """
+    if "/Resources" not in page:
+        return None
+    resources = page["/Resources"]
+    # Any text on the page needs rendering
+    if resources.get("/Font"):
+        return None
+    xobjects = resources.get("/XObject")
+    if xobjects is None:
+        return None
+    xobjects = xobjects.get_object()
+    if len(xobjects) != 1:
+        return None
+    name = list(xobjects.keys())[0]
+    peeked = None
+    if isinstance(xobjects.raw_get(name), IndirectObject):
+        peeked = peek_stream(xobjects.raw_get(name))
+    xobject = peeked[0] if peeked is not None else xobjects[name]
+    filters = xobject.get("/Filter")
+    if isinstance(filters, ArrayObject):
+        filters = filters[0] if len(filters) == 1 else None
+    if (
+        xobject.get("/Subtype") != "/Image"
+        or filters not in SCANNED_IMAGE_FILTERS
+        # Masks and remapped colours are best left to Ghostscript
+        or xobject.get("/ImageMask", False)
+        or "/SMask" in xobject
+        or "/Mask" in xobject
+        or "/Decode" in xobject
+    ):
+        return None
+
+    # The content stream of a scan only places the image, so don't bother parsing anything big
+    contents = page.get("/Contents")
+    if contents is None:
+        return None
+    contents = contents.get_object()
+    if not isinstance(contents, ArrayObject):
+        contents = [contents]
+    if sum(stream_length(stream.get_object()) for stream in contents) > 1024:
+        return None
+
+    ctm = [1.0, 0.0, 0.0, 1.0, 0.0, 0.0]
+    ctm_stack = []
+    image_ctm = None
+    for operands, operator in page.get_contents().operations:
+        if operator == b"q":
+            ctm_stack.append(ctm)
+        elif operator == b"Q":
+            ctm = ctm_stack.pop() if ctm_stack else ctm
+        elif operator == b"cm":
+            ctm = multiply_matrices([float(value) for value in operands], ctm)
+        elif operator == b"Do" and operands[0] == name and image_ctm is None:
+            image_ctm = ctm
+        elif operator not in SCANNED_PAGE_OPERATORS:
+            # Anything else draws something
+            return None
+    if image_ctm is None:
+        return None
+
+    # The image should be upright and cover the page
+    scale_x, skew_x, skew_y, scale_y = image_ctm[:4]
+    if skew_x or skew_y or scale_x <= 0 or scale_y <= 0:
+        return None
+    if scale_x < SCANNED_IMAGE_COVERAGE * float(
+        page.mediabox.width
+    ) or scale_y < SCANNED_IMAGE_COVERAGE * float(page.mediabox.height):
+        return None
+
+    return name
+
+
+def page_scanned_image(page):
+    """
+    Check whether a page is a scan, see scanned_image_name()
+
+    :return: the image XObject if the page is a scan, otherwise None
+    """
+    name = scanned_image_name(page)
+    if name is None:
+        return None
+    return page["/Resources"]["/XObject"][name]
+
+
+def decode_scanned_image(page, xobject, preview_width):
+    """
+    Decode the image of a scanned page, at (not much more than) the preview width where the format allows it.
+
+    :return: PIL image
+    """
+    filters = xobject.get("/Filter")
+    if isinstance(filters, ArrayObject):
+        filters = filters[0]
+    if filters == "/DCTDecode":
+        image = Image.open(io.BytesIO(xobject._data))
+        # JPEG can be decoded at 1/2, 1/4 or 1/8 of its size, which is much cheaper than a full decode
+        image.draft(
+            "RGB",
+            (preview_width, max(1, image.height * preview_width // image.width)),
+        )
+    elif filters == "/JPXDecode":
+        image = Image.open(io.BytesIO(xobject._data))
+    elif filters == "/JBIG2Decode":
+        # Neither Pillow nor pypdf decode JBIG2, but jbig2dec (which Ghostscript uses too) does
+        with tempfile.TemporaryDirectory() as jbig2_dir:
+            jbig2dec_command = ["jbig2dec", "--embedded", "--format", "png"]
+            jbig2dec_command += ["--output", os.path.join(jbig2_dir, "page.png")]
+            decode_parms = xobject.get("/DecodeParms") or {}
+            if "/JBIG2Globals" in decode_parms:
+                globals_path = os.path.join(jbig2_dir, "globals.jbig2")
+                with open(globals_path, "wb") as globals_file:
+                    globals_file.write(decode_parms["/JBIG2Globals"].get_data())
+                jbig2dec_command.append(globals_path)
+            page_path = os.path.join(jbig2_dir, "page.jbig2")
+            with open(page_path, "wb") as page_file:
+                page_file.write(xobject._data)
+            jbig2dec_command.append(page_path)
+            subprocess.check_call(jbig2dec_command)
+            image = Image.open(os.path.join(jbig2_dir, "page.png"))
+            image.load()
+    else:
+        # The plain (Flate, CCITT, ...) encoded images are handled by pypdf
+        image = page.images[0].image
+
+    image = image.convert("RGB")
+    # /Rotate turns the page clockwise, PIL rotates counterclockwise
+    if page.rotation % 360:
+        image = image.rotate(-page.rotation, expand=True)
+    return image
+
+
+def scale_to_width(image, width):
+    """Scale an image to the given width, keeping its aspect ratio"""
+    if image.width == width:
+        return image
+    height = max(1, int(round(image.height * width / float(image.width))))
+    return image.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+
+
+def save_page_preview(image, output_dir, page_num, preview_quality):
+    """Save the image of a page as WebP, returns the path of the preview"""
+    webp_preview_path = os.path.join(output_dir, "page_%03d.webp" % page_num)
+    image.save(webp_preview_path, "WEBP", quality=preview_quality)
+    return webp_preview_path
+
+
+def pack_sprite_sheets(sizes, columns):
+    """
+    Lay out images in sprite sheets, in rows of (up to) columns images that are as high as the highest image in the
+    row. A sheet is full when another row would make it higher than WebP allows.
+
+    :param sizes: list of the (width, height) of the images
+    :return: list of sheets, each a tuple of the (width, height) of the sheet and the list of the (x, y) positions
+    of its images, in order
+    """
+    sheets = []
+    sheet_width = 0
+    sheet_height = 0
+    positions = []
+    for start in range(0, len(sizes), columns):
+        row = sizes[start : start + columns]
+        row_height = max(height for _, height in row)
+        if positions and sheet_height + row_height > WEBP_MAX_DIMENSION:
+            sheets.append(((sheet_width, sheet_height), positions))
+            sheet_width = 0
+            sheet_height = 0
+            positions = []
+        x = 0
+        for width, _ in row:
+            positions.append((x, sheet_height))
+            x += width
+        sheet_width = max(sheet_width, x)
+        sheet_height += row_height
+    if positions:
+        sheets.append(((sheet_width, sheet_height), positions))
+    return sheets
+
+
+def save_sprite_sheets(images, output_dir, name, page_nums, columns, preview_quality):
+    """
+    Pack the images of pages in (normally a single) sprite sheet and save it as WebP. An image that is in the list
+    more than once (pages that look the same) is only packed once.
+
+    :param name: prefix of the file name of the sheets, which is followed by the page number of their first page
+    :param page_nums: list of the page numbers of the images
+    :param columns: maximum number of images next to each other
+    :return: list with for every page the path of its sprite sheet and its tile [x, y, width, height] in the sheet
+    """
+    unique_images = []
+    packed_ids = set()
+    for image, page_num in zip(images, page_nums):
+        if id(image) not in packed_ids:
+            packed_ids.add(id(image))
+            unique_images.append((image, page_num))
+    # Keep the rows within the maximum width of a WebP image
+    widest = max(image.width for image, _ in unique_images)
+    columns = max(1, min(columns, WEBP_MAX_DIMENSION // widest))
+
+    tiles = {}
+    packed = 0
+    for sheet_size, positions in pack_sprite_sheets(
+        [image.size for image, _ in unique_images], columns
+    ):
+        sheet = Image.new("RGB", sheet_size, "white")
+        sheet_path = os.path.join(
+            output_dir, "%s_%03d.webp" % (name, unique_images[packed][1])
+        )
+        for x, y in positions:
+            image = unique_images[packed][0]
+            sheet.paste(image, (x, y))
+            tiles[id(image)] = (sheet_path, [x, y, image.width, image.height])
+            packed += 1
+        sheet.save(sheet_path, "WEBP", quality=preview_quality)
+    return [tiles[id(image)] for image in images]
+
+
+def extract_page_text(page):
+    """Extract the text of a page, pages we can't get any text from are simply empty"""
+    try:
+        return page.extract_text()
+    except Exception as err:
+        logging.getLogger(__name__).debug("Failed to extract text: %s" % err)
+        return ""
+
+
+def create_page_previews(
+    file_path,
+    output_dir,
+    page_nums,
+    mode,
+    preview_width,
+    preview_quality,
+    extract_text,
+    sprite_columns=0,
+    strip_width=0,
+):
+    """
+    Create the WebP previews for pages of a PDF, and extract their text while we have the pages at hand. This is
+    pickle-able so it can run in a worker process.
+
+    :param page_nums: list of the page numbers (1-based, in order) of the pages
+
+    :param mode: tuple of whether the pages are scans (for which we decode the embedded image rather than render
+    the page) and the resolution to render the pages at
+    :param extract_text: whether to extract the text of the pages
+    :param sprite_columns: if given, the pages are packed in a sprite sheet with this many pages per row, rather
+    than saved as an image per page
+    :param strip_width: if given, also return thumbnails of the pages at this width (for the low resolution strip)
+    :return: list of the path to the WebP preview and the tile of the page in it (None if the preview is just the
+    page) for every page, list of the thumbnails (PIL images, empty if not asked for) and list of the texts of the
+    pages (empty if we don't extract text), all in page order, the time spent in every stage and the peak memory
+    of the worker and its children (see worker_peak_rss_mb())
+    """
+    logger = logging.getLogger(__name__)
+    scanned, dpi = mode
+    timings = StageTimings()
+
+    previews = []
+    page_images = []
+    thumbnails = []
+    page_texts = []
+    with contextlib.ExitStack() as stack:
+        pages = [None] * len(page_nums)
+        if scanned or extract_text:
+            if worker_pdf.get("file_path") != file_path:
+                # Not in a worker process that has the document open already, open it just for these pages
+                open_worker_pdf(file_path)
+                stack.callback(close_worker_pdf)
+            # Leave the reader as we found it, without the images and content streams of our pages
+            reader = worker_pdf["reader"]
+            stack.callback(drop_cached_streams, reader, len(reader.resolved_objects))
+            pages = worker_pages(page_nums)
+        if not scanned:
+            rendered_images = render_pages(file_path, page_nums, dpi)
+
+        for page_num, page in zip(page_nums, pages):
+            if scanned:
+                try:
+                    with timings.stage("decode_scanned"):
+                        image = decode_scanned_image(
+                            page, page_scanned_image(page), preview_width
+                        )
+                except Exception as err:
+                    # Whatever the reason, Ghostscript can still render the page
+                    logger.debug(
+                        "Failed to decode the image of page %d (%s), rendering it instead"
+                        % (page_num, err)
+                    )
+                    with timings.stage("render"):
+                        image = next(render_pages(file_path, [page_num], dpi))
+            else:
+                with timings.stage("render"):
+                    image = next(rendered_images, None)
+                if image is None:
+                    raise ValueError(
+                        "Ghostscript rendered fewer pages than the %d requested"
+                        % len(page_nums)
+                    )
+            # Rounding in Ghostscript can leave us a pixel off the requested width, decoded images can be any size
+            with timings.stage("resize"):
+                image = scale_to_width(image, preview_width)
+                if strip_width:
+                    thumbnails.append(scale_to_width(image, strip_width))
+            if sprite_columns:
+                page_images.append(image)
+            else:
+                with timings.stage("encode"):
+                    previews.append(
+                        (
+                            save_page_preview(
+                                image, output_dir, page_num, preview_quality
+                            ),
+                            None,
+                        )
+                    )
+            if extract_text:
+                with timings.stage("extract_text"):
+                    page_texts.append(extract_page_text(page))
+
+        if not scanned:
+            # Let Ghostscript finish (and check it did so without errors)
+            with timings.stage("render"):
+                for _ in rendered_images:
+                    pass
+
+    if page_images:
+        with timings.stage("encode"):
+            previews = save_sprite_sheets(
+                page_images,
+                output_dir,
+                "sheet",
+                page_nums,
+                sprite_columns,
+                preview_quality,
+            )
+
+    return previews, thumbnails, page_texts, timings.seconds, worker_peak_rss_mb()
+
+
+class PageTextCollector:
+    """
+    Collect the text of the pages of a document as it comes in (in page order). The text is streamed into a plain
+    text file with a form feed after every page (like pdftotext does) and we keep track of the pages every term
+    occurs on, for a term to page index.
+    """
+
+    def __init__(self, text_path):
+        """
+        :param text_path: path of the text file to write
+        """
+        self.text_path = text_path
+        self.text_file = open(text_path, "w", encoding="utf-8")
+        self.num_pages = 0
+        self.term_counts = collections.Counter()
+        self.term_pages = collections.defaultdict(list)
+
+    def add(self, page_num, text):
+        """Add the text of the next page"""
+        self.text_file.write(text.replace("\f", " ") + "\f")
+        self.num_pages += 1
+        terms = [term.lower() for term in TEXT_TERM_PATTERN.findall(text)]
+        self.term_counts.update(terms)
+        for term in set(terms):
+            self.term_pages[term].append(page_num)
+
+    def close(self):
+        self.text_file.close()
+
+    def index(self, max_terms, max_pages):
+        """
+        Term to page index of the text. Stopwords and terms that occur on most pages are left out, the terms that
+        are kept are the ones that best tell the pages apart: frequent, but on few pages (by TF-IDF).
+
+        :param max_terms: maximum number of terms in the index
+        :param max_pages: maximum number of pages listed per term (the first pages it occurs on), 0 means all pages
+        :return: dict of the terms and the (sorted) page numbers they occur on
+        """
+        max_term_pages = self.num_pages
+        if self.num_pages >= TEXT_INDEX_MIN_PAGES:
+            max_term_pages = TEXT_INDEX_MAX_PAGE_FRACTION * self.num_pages
+        candidates = [
+            term
+            for term, pages in self.term_pages.items()
+            if term not in TEXT_STOPWORDS and len(pages) <= max_term_pages
+        ]
+
+        def score(term):
+            return self.term_counts[term] * math.log(
+                1 + self.num_pages / len(self.term_pages[term])
+            )
+
+        terms = sorted(candidates, key=lambda term: (-score(term), term))[:max_terms]
+        return dict(
+            [
+                (term, self.term_pages[term][: max_pages or None])
+                for term in sorted(terms)
+            ]
+        )
+
+
+def stream_length(stream):
+    """Size of a stream as stored in the file (i.e. still encoded)"""
+    # pypdf drops /Length when it reads a stream, but keeps the data as it was stored
+    return len(getattr(stream, "_data", None) or b"")
+
+
+def peek_stream(reference):
+    """
+    Read the dictionary of a stream object straight from the file, without its data. pypdf reads the data of a stream
+    along with its dictionary (and caches it for as long as the reader is open), which for images and fonts adds up
+    to about the size of the file.
+
+    :param reference: IndirectObject of the stream
+    :return: tuple of the dictionary, the position of the data in the file and its length (as stored, i.e. still
+    encoded), or None if the object isn't a stream (or we can't tell, then it is best read by pypdf)
+    """
+    reader = reference.pdf
+    # Objects in object streams are never streams themselves
+    if reference.idnum in reader.xref_objStm:
+        return None
+    offset = reader.xref.get(reference.generation, {}).get(reference.idnum)
+    if offset is None:
+        return None
+    stream = reader.stream
+    stream.seek(offset)
+    header = stream.read(STREAM_DICTIONARY_MAX_BYTES)
+    match = STREAM_KEYWORD_PATTERN.search(header)
+    if match is None or b"endobj" in header[: match.start()]:
+        return None
+    try:
+        header_stream = io.BytesIO(header[: match.start() + 2])
+        reader.read_object_header(header_stream)
+        dictionary = DictionaryObject.read_from_stream(header_stream, reader)
+        length = dictionary.get("/Length")
+    except (PdfReadError, ValueError):
+        return None
+    if not isinstance(length, int) or length < 0:
+        return None
+    return dictionary, offset + match.end(), int(length)
+
+
+def resource_stream_bytes(resources, seen):
+    """
+    Walk the resources of a page (and of the form XObjects it uses) and add up how many bytes of the file are
+    embedded images and embedded fonts.
+
+    :param resources: the (possibly indirect) resource dictionary of the page
+    :param seen: set of the objects that were already counted (for resources shared between pages), gets updated
+    :return: tuple of the number of bytes in images and in fonts
+    """
+    image_bytes = 0
+    font_bytes = 0
+
+    def resolve(obj):
+        """Resolve an indirect object, returns None if we have been there before"""
+        if isinstance(obj, IndirectObject):
+            if (obj.idnum, obj.generation) in seen:
+                return None
+            seen.add((obj.idnum, obj.generation))
+            obj = obj.get_object()
+        return obj
+
+    def resolve_stream(obj):
+        """
+        Get the dictionary and the size of a stream without reading its data, returns None if we have been there
+        before
+        """
+        if isinstance(obj, IndirectObject):
+            if (obj.idnum, obj.generation) in seen:
+                return None
+            seen.add((obj.idnum, obj.generation))
+            peeked = peek_stream(obj)
+            if peeked is not None:
+                return peeked[0], peeked[2]
+            obj = obj.get_object()
+        return obj, stream_length(obj)
+
+    def font_files(font):
+        fonts = [font]
+        # Composite fonts keep the actual font in their descendant
+        fonts += [
+            descendant.get_object() for descendant in font.get("/DescendantFonts", [])
+        ]
+        for font in fonts:
+            descriptor = font.get("/FontDescriptor")
+            if descriptor is None:
+                continue
+            descriptor = descriptor.get_object()
+            for key in ["/FontFile", "/FontFile2", "/FontFile3"]:
+                if key in descriptor:
+                    font_file = resolve_stream(descriptor.raw_get(key))
+                    if font_file is not None:
+                        yield font_file[1]
+
+    def walk(resources):
+        nonlocal image_bytes, font_bytes
+        resources = resolve(resources)
+        if not resources:
+            return
+        for font in resources.get("/Font", {}).values():
+            font = resolve(font)
+            if font is None:
+                continue
+            for font_file_bytes in font_files(font):
+                font_bytes += font_file_bytes
+        for xobject in resources.get("/XObject", {}).values():
+            xobject = resolve_stream(xobject)
+            if xobject is None:
+                continue
+            xobject, xobject_bytes = xobject
+            if xobject.get("/Subtype") == "/Image":
+                image_bytes += xobject_bytes
+                # Soft masks are images too
+                smask = (
+                    resolve_stream(xobject.raw_get("/SMask"))
+                    if "/SMask" in xobject
+                    else None
+                )
+                if smask is not None:
+                    image_bytes += smask[1]
+            elif xobject.get("/Subtype") == "/Form" and "/Resources" in xobject:
+                walk(xobject.raw_get("/Resources"))
+
+    walk(resources)
+
+    return image_bytes, font_bytes
+
+
+def stream_chunks(reader, offset, length):
+    """
+    Yield the data of a stream straight from the file, a chunk at a time. With the file mapped into memory, the
+    pages of each chunk are given back once it is read (they stay in the page cache).
+    """
+    end = offset + length
+    while offset < end:
+        reader.stream.seek(offset)
+        chunk = reader.stream.read(min(FINGERPRINT_CHUNK_BYTES, end - offset))
+        if not chunk:
+            return
+        if isinstance(reader.stream, mmap.mmap) and hasattr(mmap, "MADV_DONTNEED"):
+            start = offset - offset % mmap.PAGESIZE
+            reader.stream.madvise(
+                mmap.MADV_DONTNEED, start, offset + len(chunk) - start
+            )
+        offset += len(chunk)
+        yield chunk
+
+
+def object_digest(obj, digests, stream_data=None):
+    """
+    Digest of a PDF object and everything it refers to, by content, so copies of the same object elsewhere in the
+    file get the same digest. Streams are read from the file a chunk at a time, rather than through pypdf (which
+    would keep their data around for as long as the reader is open).
+
+    :param digests: dict of the digests of the indirect objects done so far (shared between calls), gets updated
+    :param stream_data: chunks of the data of the stream, if obj is the dictionary of a stream read by peek_stream()
+    """
+    if isinstance(obj, IndirectObject):
+        key = (obj.idnum, obj.generation)
+        if key not in digests:
+            # Should the object (indirectly) refer back to itself, that reference counts by its object number
+            digests[key] = ("loop %d %d" % key).encode()
+            peeked = peek_stream(obj)
+            if peeked is not None:
+                dictionary, offset, length = peeked
+                digests[key] = object_digest(
+                    dictionary, digests, stream_chunks(obj.pdf, offset, length)
+                )
+            else:
+                digests[key] = object_digest(obj.get_object(), digests)
+        return digests[key]
+
+    if isinstance(obj, StreamObject):
+        # The data as it is stored, no need to decode it
+        stream_data = [getattr(obj, "_data", None) or b""]
+    # pypdf has several classes of streams, depending on how they were read
+    hasher = hashlib.sha1(
+        b"StreamObject" if stream_data is not None else type(obj).__name__.encode()
+    )
+    if isinstance(obj, DictionaryObject):
+        for key in sorted(obj.keys()):
+            if key in FINGERPRINT_IGNORED_KEYS:
+                continue
+            hasher.update(key.encode())
+            hasher.update(object_digest(obj.raw_get(key), digests))
+        for chunk in stream_data or []:
+            hasher.update(chunk)
+    elif isinstance(obj, ArrayObject):
+        for item in obj:
+            hasher.update(object_digest(item, digests))
+    else:
+        hasher.update(repr(obj).encode("utf-8", "replace"))
+    return hasher.digest()
+
+
+def page_fingerprint(page, digests):
+    """
+    Fingerprint of what a page looks like: its content streams, the resources they use, its boxes and rotation.
+    Pages with the same fingerprint render the same.
+
+    :param digests: dict of the digests of the indirect objects done so far (shared between pages), gets updated
+    :return: hex digest, or None for pages with annotations (which we don't compare)
+    """
+    if "/Annots" in page and page["/Annots"]:
+        return None
+    hasher = hashlib.sha1()
+    for key in FINGERPRINT_PAGE_ATTRIBUTES:
+        if key in page:
+            hasher.update(key.encode())
+            hasher.update(object_digest(page.raw_get(key), digests))
+    return hasher.hexdigest()
+
+
+def open_pdf(file_path):
+    """
+    Open a PDF with pypdf through a memory map of the file, so what pypdf reads comes straight from the page cache
+    (which the kernel can reclaim) rather than from copies in our own memory.
+
+    :return: context manager giving the reader
+    """
+
+    @contextlib.contextmanager
+    def mapped_reader():
+        with open(file_path, "rb") as pdf_file:
+            with mmap.mmap(pdf_file.fileno(), 0, access=mmap.ACCESS_READ) as pdf_map:
+                yield PdfReader(pdf_map)
+
+    return mapped_reader()
+
+
+def walk_page_tree(reader):
+    """
+    Yield the pages of a PDF one at a time, with the attributes they inherit from the page tree filled in. Unlike
+    reader.pages this doesn't build (and hold on to) a flattened list of all the pages up front.
+    """
+    visited = set()
+
+    def walk(node_reference, inherited):
+        if isinstance(node_reference, IndirectObject):
+            # Protect ourselves against broken files with loops in the page tree
+            if (node_reference.idnum, node_reference.generation) in visited:
+                return
+            visited.add((node_reference.idnum, node_reference.generation))
+        node = node_reference.get_object()
+        if "/Kids" in node:
+            inherited = dict(inherited)
+            for key in INHERITABLE_PAGE_ATTRIBUTES:
+                if key in node:
+                    inherited[key] = node.raw_get(key)
+            for kid in node["/Kids"]:
+                yield from walk(kid, inherited)
+        else:
+            page = PageObject(
+                reader,
+                node_reference if isinstance(node_reference, IndirectObject) else None,
+            )
+            page.update(node)
+            for key, value in inherited.items():
+                if key not in page:
+                    page[NameObject(key)] = value
+            yield page
+
+    yield from walk(reader.trailer["/Root"].raw_get("/Pages"), {})
+
+
+def drop_cached_streams(reader, cached_objects):
+    """
+    pypdf caches every object it reads, streams (images, fonts, content) included, for as long as the reader is
+    open. Drop the streams it read since it had cached_objects objects, once we are done with them.
+    """
+    new_objects = itertools.islice(
+        reversed(reader.resolved_objects.items()),
+        len(reader.resolved_objects) - cached_objects,
+    )
+    for key in [key for key, obj in new_objects if isinstance(obj, StreamObject)]:
+        del reader.resolved_objects[key]
+
+
+# The document the render worker processes have open, see open_worker_pdf()
+worker_pdf = {}
+
+
+def open_worker_pdf(file_path):
+    """
+    Open a PDF for the ranges of pages this (worker) process gets, used as initializer of the pool of render
+    workers. Every worker parses the cross-reference table once and walks the page tree (only as far as the
+    pages it needs) once, rather than for every range.
+    """
+    close_worker_pdf()
+    stack = contextlib.ExitStack()
+    reader = stack.enter_context(open_pdf(file_path))
+    worker_pdf.update(
+        file_path=file_path,
+        stack=stack,
+        reader=reader,
+        page_tree=walk_page_tree(reader),
+        pages=[],
+    )
+
+
+def close_worker_pdf():
+    """Close the PDF opened by open_worker_pdf(), if any"""
+    if "stack" in worker_pdf:
+        worker_pdf["stack"].close()
+    worker_pdf.clear()
+
+
+def worker_pages(page_nums):
+    """
+    Get pages of the PDF opened by open_worker_pdf(). The other pages are only visited in the page tree, only
+    these get parsed.
+
+    :param page_nums: list of the page numbers (1-based, in order) of the pages
+    """
+    pages = worker_pdf["pages"]
+    pages.extend(
+        itertools.islice(worker_pdf["page_tree"], max(0, page_nums[-1] - len(pages)))
+    )
+    return [pages[page_num - 1] for page_num in page_nums if page_num <= len(pages)]
+
+
+def inspect_pdf(file_path, preview_width, fingerprint_pages=False):
+    """
+    Gather everything we need to know about a PDF in a single walk over its page tree, so that the reader (and
+    everything it has cached) can be released before the heavy lifting starts.
+
+    :param preview_width: width of the page previews, to work out the resolution to render the pages at
+    :param fingerprint_pages: whether to fingerprint the pages, to find the pages that look the same
+    :return: dict with the number of pages, how every page gets its preview (tuples of whether the page is a scan
+    and the resolution to render it at), the fingerprints of the pages (None for pages without one) and the number
+    of bytes in embedded images and fonts
+    """
+    page_modes = []
+    page_fingerprints = []
+    image_bytes = 0
+    font_bytes = 0
+    seen = set()
+    digests = {}
+    with open_pdf(file_path) as reader:
+        for page in walk_page_tree(reader):
+            cached_objects = len(reader.resolved_objects)
+            page_modes.append(
+                (
+                    scanned_image_name(page) is not None,
+                    page_preview_dpi(page, preview_width),
+                )
+            )
+            page_fingerprints.append(
+                page_fingerprint(page, digests) if fingerprint_pages else None
+            )
+            if "/Resources" in page:
+                page_image_bytes, page_font_bytes = resource_stream_bytes(
+                    page.raw_get("/Resources"), seen
+                )
+                image_bytes += page_image_bytes
+                font_bytes += page_font_bytes
+            # We are done with the streams of this page
+            drop_cached_streams(reader, cached_objects)
+        page = None
+        del reader
+    # pypdf objects refer back to their reader, so it takes the garbage collector to really free them
+    gc.collect()
+
+    return {
+        "num_pages": len(page_modes),
+        "page_modes": page_modes,
+        "page_fingerprints": page_fingerprints,
+        "image_bytes": image_bytes,
+        "font_bytes": font_bytes,
+    }
+
+
+def reset_peak_rss():
+    """Reset the peak RSS the kernel keeps for this process (so we can measure it per document), if allowed to"""
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except (IOError, OSError):
+        pass
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process (since reset_peak_rss()), in MB"""
+    own_peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with open("/proc/self/status", "r") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    own_peak_kb = int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return own_peak_kb / 1024.0
+
+
+def reap_child(process, wait=True):
+    """
+    Wait for a child process (subprocess.Popen) to end, like process.wait() (or process.poll() if not wait), and get
+    its peak resident memory. The kernel only gives that per child to whoever waits for it, RUSAGE_CHILDREN is the
+    largest child over the whole life of the process (so useless for the documents after the first one).
+
+    :return: peak RSS of the child in MB, or None if it is still running
+    """
+    if process.returncode is not None:
+        # Already waited for, without us
+        return 0.0
+    pid, status, usage = os.wait4(process.pid, 0 if wait else os.WNOHANG)
+    if pid == 0:
+        return None
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return usage.ru_maxrss / 1024.0
+
+
+def worker_peak_rss_mb():
+    """
+    Peak resident memory of this render worker process and of the largest child it waited for (Ghostscript,
+    jbig2dec), in MB. The pool of workers is new for every batch of pages, so both are those of the document.
+    """
+    if multiprocessing.parent_process() is None:
+        # Not a worker, we can't tell what belongs to this document
+        return 0.0
+    children_peak_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(peak_rss_mb(), children_peak_kb / 1024.0)
+
+
+def plan_pdf_compression(pdf_info, file_bytes):
+    """
+    Decide which Ghostscript profile(s) to use to compress a PDF to below MAX_PDF_MB, based on how its bytes are
+    distributed over images, fonts and everything else. A lossless rewrite hardly changes the size of the (already
+    compressed) images, so for image heavy documents it is a waste of time and we go straight to lossy compression.
+
+    :return: list of the profiles to try, in order of preference
+    """
+    logger = logging.getLogger(__name__)
+
+    image_bytes = pdf_info["image_bytes"]
+    font_bytes = pdf_info["font_bytes"]
+    other_bytes = max(0, file_bytes - image_bytes - font_bytes)
+    estimate = (
+        LOSSLESS_IMAGE_RATIO * image_bytes
+        + LOSSLESS_FONT_RATIO * font_bytes
+        + LOSSLESS_OTHER_RATIO * other_bytes
+    )
+    max_bytes = MAX_PDF_MB * 1024 * 1024
+    logger.debug(
+        "PDF has %8.2f MB of images, %8.2f MB of fonts and %8.2f MB of other data, "
+        "estimated size after lossless compression is %8.2f MB"
+        % tuple(
+            size / (1024 * 1024)
+            for size in [image_bytes, font_bytes, other_bytes, estimate]
+        )
+    )
+
+    if estimate > max_bytes * (1 + PLANNER_UNCERTAINTY):
+        return ["ebook"]
+    if estimate < max_bytes * (1 - PLANNER_UNCERTAINTY):
+        return ["lossless"]
+    # Too close to call
+    return ["lossless", "ebook"]
+
+
+def linearize_pdf(input_path, output_path, timings=None):
+    """
+    Write a linearized ("fast web view") copy of a PDF with qpdf, which lets a viewer show the first page before
+    the whole file is in (using HTTP range requests).
+
+    :param timings: StageTimings to add the peak memory of qpdf to
+    :return: whether it worked, output_path is only left behind if it did
+    """
+    try:
+        qpdf_process = subprocess.Popen(
+            ["qpdf", "--linearize", input_path, output_path]
+        )
+    except OSError as err:
+        logging.getLogger(__name__).warning("Failed to run qpdf: %s" % err)
+        return False
+    child_peak_mb = reap_child(qpdf_process)
+    if timings is not None:
+        timings.add_child_peak(child_peak_mb)
+    returncode = qpdf_process.returncode
+    # qpdf exits with 3 when it had to work around problems in the file, the output is still good
+    if returncode in (0, 3) and os.path.exists(output_path):
+        return True
+    logging.getLogger(__name__).error(
+        "qpdf linearization of %s failed (exit code %d)" % (input_path, returncode)
+    )
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    return False
+
+
+def create_preview_pdf(pdf_info, file_path, preview_path, linearize=True, timings=None):
+    """
+    Make a preview-able copy of a PDF: a plain copy if it is small enough, otherwise compressed with Ghostscript.
+    Which compression profile gets used is decided up front, when in doubt the candidates run concurrently and we
+    keep the best result.
+
+    :param linearize: whether to linearize the preview (where the plain copy or compressed PDF is written by qpdf)
+    :param timings: StageTimings to add the time spent on every compression profile and on linearizing to
+    :return: whether the preview is linearized
+    """
+    logger = logging.getLogger(__name__)
+    if timings is None:
+        timings = StageTimings()
+
+    def copy_preview(source_path, keep_source):
+        """Put source_path in place as preview, linearized if we can"""
+        if linearize:
+            with timings.stage("linearize"):
+                linearized = linearize_pdf(source_path, preview_path, timings)
+            if linearized:
+                if not keep_source:
+                    os.remove(source_path)
+                return True
+        if keep_source:
+            shutil.copyfile(source_path, preview_path)
+        else:
+            os.rename(source_path, preview_path)
+        return False
+
+    file_bytes = os.stat(file_path).st_size
+    file_mb = file_bytes / (1024 * 1024)
+    if file_mb < MAX_PDF_MB:
+        # Make a copy of the file as  preview
+        logger.debug("PDF size is %8.2f MB, making a plain copy" % file_mb)
+        return copy_preview(file_path, True)
+
+    def compress(profiles):
+        """Run Ghostscript with the given profiles concurrently, returns the (size in MB, profile, path) of results"""
+        start = time.monotonic()
+        gs_processes = []
+        for profile in profiles:
+            output_path = "%s.%s.pdf" % (preview_path, profile)
+            gs_processes.append(
+                (
+                    profile,
+                    output_path,
+                    subprocess.Popen(
+                        [
+                            "gs",
+                            "-sDEVICE=pdfwrite",
+                            "-dCompatibilityLevel=1.4",
+                        ]
+                        + PDF_COMPRESSION_PROFILES[profile]
+                        + [
+                            "-dNOPAUSE",
+                            "-dQUIET",
+                            "-dBATCH",
+                            "-sOutputFile=%s" % output_path,
+                            file_path,
+                        ]
+                    ),
+                )
+            )
+
+        # Note when each of the concurrent runs finishes, for the time every profile takes
+        running = list(gs_processes)
+        while running:
+            for profile, output_path, gs_process in list(running):
+                child_peak_mb = reap_child(gs_process, wait=False)
+                if child_peak_mb is not None:
+                    timings.add_child_peak(child_peak_mb)
+                    timings.add("compress_%s" % profile, time.monotonic() - start)
+                    running.remove((profile, output_path, gs_process))
+            if running:
+                time.sleep(0.05)
+
+        candidates = []
+        for profile, output_path, gs_process in gs_processes:
+            if gs_process.wait() == 0 and os.path.exists(output_path):
+                output_mb = os.stat(output_path).st_size / (1024 * 1024)
+                logger.debug("%s compression gives %8.2f MB" % (profile, output_mb))
+                candidates.append((output_mb, profile, output_path))
+            else:
+                logger.error(
+                    "%s ghostscript compression of %s failed" % (profile, file_path)
+                )
+        return candidates
+
+    profiles = plan_pdf_compression(pdf_info, file_bytes)
+    logger.debug(
+        "PDF size is %8.2f MB, attempting compression with %s"
+        % (file_mb, " and ".join(profiles))
+    )
+    candidates = compress(profiles)
+    # Should the planner have been wrong, fall back on the profiles it skipped (i.e. be more aggressive)
+    skipped = [
+        profile for profile in PDF_COMPRESSION_PROFILES if profile not in profiles
+    ]
+    if skipped and not any(candidate[0] <= MAX_PDF_MB for candidate in candidates):
+        logger.debug(
+            "PDF is still too big, attempting compression with %s"
+            % " and ".join(skipped)
+        )
+        candidates += compress(skipped)
+
+    if not candidates:
+        # If we failed to do ghostscript compression, just make a copy
+        logger.debug("Ghostscript compression of PDF failed, making a plain copy")
+        return copy_preview(file_path, True)
+
+    # Take the preferred profile if it is small enough, otherwise whatever came out smallest
+    fitting = [candidate for candidate in candidates if candidate[0] <= MAX_PDF_MB]
+    output_mb, profile, output_path = fitting[0] if fitting else min(candidates)
+    logger.debug("Using %s compression (%8.2f MB)" % (profile, output_mb))
+    for _, _, other_output_path in candidates:
+        if other_output_path != output_path:
+            os.remove(other_output_path)
+    return copy_preview(output_path, False)
+
+
+def cache_key_for(file_path, settings):
+    """
+    Key of the cached previews of a file: the SHA-256 of the file contents together with all the settings that
+    change the previews we make of it
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as pdf_file:
+        for block in iter(lambda: pdf_file.read(1024 * 1024), b""):
+            sha256.update(block)
+    rendering = dict(
+        [(key, settings[key]) for key in settings if key not in CACHE_IGNORED_SETTINGS]
+    )
+    rendering["max_pdf_mb"] = MAX_PDF_MB
+    sha256.update(json.dumps(rendering, sort_keys=True).encode("utf-8"))
+    return sha256.hexdigest()
+
+
+def manifest_files(manifest):
+    """List the paths of all the files in a cache manifest"""
+    files = [manifest[key] for key in CACHE_FILE_KEYS if manifest.get(key)]
+    for key in CACHE_FILE_LIST_KEYS:
+        files += manifest.get(key) or []
+    # Pages that share an image (e.g. a sprite sheet) list the same file
+    return list(dict.fromkeys(files))
+
+
+def relocate_manifest(manifest, directory):
+    """Copy of a cache manifest with the paths of all the files pointing to directory"""
+    relocated = dict(manifest)
+    for key in CACHE_FILE_KEYS:
+        if manifest.get(key):
+            relocated[key] = os.path.join(directory, os.path.basename(manifest[key]))
+    for key in CACHE_FILE_LIST_KEYS:
+        if manifest.get(key):
+            relocated[key] = [
+                os.path.join(directory, os.path.basename(path))
+                for path in manifest[key]
+            ]
+    return relocated
+
+
+def cache_lookup(cache_key, output_dir):
+    """
+    Look for cached previews and copy them to output_dir (so they can't be evicted while we upload them).
+
+    :return: None if not in the cache, otherwise the cached manifest with the paths pointing to the copies
+    """
+    entry_dir = os.path.join(CACHE_DIR, cache_key)
+    try:
+        with open(os.path.join(entry_dir, "manifest.json"), "r") as manifest_file:
+            manifest = json.load(manifest_file)
+        # Mark the entry as recently used for the LRU eviction
+        os.utime(entry_dir, None)
+        for path in manifest_files(manifest):
+            shutil.copyfile(
+                os.path.join(entry_dir, path), os.path.join(output_dir, path)
+            )
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+    return relocate_manifest(manifest, output_dir)
+
+
+def cache_store(cache_key, manifest):
+    """
+    Store the previews of a file in the cache, then evict the least recently used entries to stay within the size
+    limit of the cache.
+
+    :param manifest: dict with the path of the preview PDF ("preview_pdf"), of the page previews ("preview_images"),
+    of any other files in CACHE_FILE_KEYS and CACHE_FILE_LIST_KEYS plus any other results we want back on a cache
+    hit
+    """
+    logger = logging.getLogger(__name__)
+
+    entry_dir = os.path.join(CACHE_DIR, cache_key)
+    if os.path.isdir(entry_dir):
+        return
+
+    # Build the entry next to where it needs to go and move it in place in one go, so other workers never see a
+    # partial entry
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix=".staging-", dir=CACHE_DIR)
+    try:
+        for path in manifest_files(manifest):
+            shutil.copyfile(path, os.path.join(staging_dir, os.path.basename(path)))
+        # Files are stored relative to the entry
+        stored = relocate_manifest(manifest, "")
+        with open(os.path.join(staging_dir, "manifest.json"), "w") as manifest_file:
+            json.dump(stored, manifest_file)
+        os.rename(staging_dir, entry_dir)
+    except (IOError, OSError) as err:
+        # Most likely another worker stored the same file in the meantime
+        logger.warning("Failed to store previews in cache: %s" % err)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    cache_evict(CACHE_MAX_MB * 1024 * 1024)
+
+
+def cache_evict(max_bytes):
+    """Remove the least recently used cache entries until the cache is no larger than max_bytes"""
+    entries = []
+    total_bytes = 0
+    for name in os.listdir(CACHE_DIR):
+        entry_dir = os.path.join(CACHE_DIR, name)
+        if name.startswith(".") or not os.path.isdir(entry_dir):
+            continue
+        try:
+            entry_bytes = sum(
+                os.stat(os.path.join(entry_dir, path)).st_size
+                for path in os.listdir(entry_dir)
+            )
+            entries.append((os.stat(entry_dir).st_mtime, entry_bytes, entry_dir))
+        except OSError:
+            # Evicted by another worker
+            continue
+        total_bytes += entry_bytes
+
+    entries.sort()
+    while total_bytes > max_bytes and entries:
+        _, entry_bytes, entry_dir = entries.pop(0)
+        logging.getLogger(__name__).debug("Evicting %s from cache" % entry_dir)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_bytes -= entry_bytes
+
+
+def bounded_imap(pool, func, iterable, max_pending):
+    """
+    Like Pool.imap (results come back in order, as soon as they are ready), but never runs more than max_pending
+    tasks ahead of the consumer, so results can't pile up when the consumer is the slower side.
+    """
+    pending = collections.deque()
+    for args in iterable:
+        pending.append(pool.apply_async(func, args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class PreviewUploader:
+    """
+    Upload previews on a small pool of threads that drain a bounded queue, so uploading overlaps with rendering.
+    The preview IDs are kept in the order in which the previews were queued.
+    """
+
+    def __init__(self, upload_func, threads, queue_size, timings=None):
+        """
+        :param upload_func: function taking the path of a preview, uploading it and returning its ID
+        :param threads: number of upload threads
+        :param queue_size: maximum number of previews waiting for an upload thread (put() blocks when full)
+        :param timings: StageTimings to add the time spent uploading to
+        """
+        self.upload_func = upload_func
+        self.timings = timings or StageTimings()
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.preview_ids = []
+        self.queued = {}
+        self.errors = []
+        self.lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self._upload_worker, daemon=True)
+            for _ in range(threads)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, preview_path):
+        """Queue a preview for upload, returns the index its ID will have in the list returned by join()"""
+        with self.lock:
+            index = len(self.preview_ids)
+            self.preview_ids.append(None)
+        self.queue.put((index, preview_path))
+        return index
+
+    def put_once(self, preview_path):
+        """Like put(), but a preview that was queued before is not uploaded again (returns the same index)"""
+        if preview_path not in self.queued:
+            self.queued[preview_path] = self.put(preview_path)
+        return self.queued[preview_path]
+
+    def wait(self):
+        """
+        Wait for the uploads queued so far to finish (the upload threads keep running), raises the first upload
+        error if there was one.
+
+        :return: copy of the list of preview IDs
+        """
+        self.queue.join()
+        with self.lock:
+            if self.errors:
+                raise self.errors[0]
+            return list(self.preview_ids)
+
+    def join(self):
+        """Wait for all queued uploads to finish, raises the first upload error if there was one"""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+        return self.preview_ids
+
+    def _upload_worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            index, preview_path = item
+            try:
+                with self.timings.stage("upload"):
+                    preview_id = self.upload_func(preview_path)
+            except Exception as err:
+                logging.getLogger(__name__).exception(
+                    "Upload of preview %s failed" % preview_path
+                )
+                with self.lock:
+                    self.errors.append(err)
+            else:
+                with self.lock:
+                    self.preview_ids[index] = preview_id
+            finally:
+                self.queue.task_done()
 
 
 class PDFExtractor(Extractor):
@@ -32,157 +1682,562 @@ class PDFExtractor(Extractor):
 
         logger.debug(resource)
 
-        # Process the PDF file
-        with open(file_path, "rb") as pdf_file:
-            reader = PdfReader(pdf_file)
-
-            tempdir = tempfile.mkdtemp()
-            preview_path = os.path.join(tempdir, file_name)
-
-            file_stats = os.stat(file_path)
-            file_mb = file_stats.st_size / (1024 * 1024)
-            copy_failed = False
-            if file_mb < MAX_PDF_MB:
-                # Make a copy of the file as  preview
-                logger.debug("PDF size is %8.2f MB, making a plain copy" % file_mb)
-                shutil.copyfile(file_path, preview_path)
-            else:
-                # Do a lossless compression with Ghostscript
-                logger.debug("PDF size is %8.2f MB, attempting compression" % file_mb)
-                try:
-                    subprocess.check_call(
-                        [
-                            "gs",
-                            "-sDEVICE=pdfwrite",
-                            "-dCompatibilityLevel=1.4",
-                            "-dNOPAUSE",
-                            "-dQUIET",
-                            "-dBATCH",
-                            "-sOutputFile=%s" % preview_path,
-                            file_path,
-                        ]
+        # Allow the default settings to be overridden by the parameters of the submission
+        settings = dict(default_settings)  # make sure it's a copy
+        usersettings = parameters.get("parameters", {})
+        if isinstance(usersettings, dict):
+            settings.update(
+                dict(
+                    [
+                        (key, usersettings[key])
+                        for key in usersettings
+                        if key in default_settings.keys()
+                    ]
+                )
+            )
+        logger.debug("Using settings: %s" % settings)
+
+        # Measure the time and memory use of every document separately
+        reset_peak_rss()
+        start = time.monotonic()
+        timings = StageTimings()
+
+        tempdir = tempfile.mkdtemp()
+        preview_path = os.path.join(tempdir, file_name)
+
+        # Uploads happen in the background, while we get on with rendering the page previews
+        uploader = PreviewUploader(
+            lambda upload_path: upload_preview(
+                connector, host, secret_key, file_id, upload_path, None
+            ),
+            max(1, int(settings["upload_threads"])),
+            max(1, int(settings["upload_queue_size"])),
+            timings,
+        )
+
+        # Whether metadata for just the first batch of pages went up, which the final metadata then replaces
+        partial_metadata = False
+
+        # If we have seen the same file with the same settings before, we can reuse the previews we made then
+        cache_key = None
+        cached = None
+        if CACHE_DIR:
+            with timings.stage("hash"):
+                cache_key = cache_key_for(file_path, settings)
+            with timings.stage("cache_lookup"):
+                cached = cache_lookup(cache_key, tempdir)
+
+        try:
+            if cached:
+                logger.debug("Uploading previews from cache entry %s" % cache_key)
+                shutil.move(cached["preview_pdf"], preview_path)
+                num_pages = cached["num_pages"]
+                preview_index = uploader.put(preview_path)
+                preview_images = [
+                    (uploader.put_once(webp_preview_path), webp_preview_path, tile)
+                    for webp_preview_path, tile in zip(
+                        cached["preview_images"],
+                        cached.get("preview_tiles") or itertools.repeat(None),
                     )
-                    # If file is still too big, be more aggressive
-                    file_stats = os.stat(preview_path)
-                    file_mb = file_stats.st_size / (1024 * 1024)
-                    if file_mb > MAX_PDF_MB:
-                        logger.debug(
-                            "PDF size is still %8.2f MB, attempting lossy compression"
-                            % file_mb
-                        )
-                        try:
-                            subprocess.check_call(
-                                [
-                                    "gs",
-                                    "-sDEVICE=pdfwrite",
-                                    "-dCompatibilityLevel=1.4",
-                                    "-dPDFSETTINGS=/ebook",
-                                    "-dNOPAUSE",
-                                    "-dQUIET",
-                                    "-dBATCH",
-                                    "-sOutputFile=%s" % preview_path,
-                                    file_path,
-                                ]
-                            )
-                        except subprocess.CalledProcessError as e:
-                            logging.getLogger().exception(
-                                "Lossy ghostscript compression of " + inputfile
-                            )
-                            copy_failed = True
-                except subprocess.CalledProcessError as e:
-                    logging.getLogger().exception(
-                        "ghostscript compression of " + inputfile
+                ]
+                strip_images = [
+                    (uploader.put_once(strip_path), strip_path, tile)
+                    for strip_path, tile in zip(
+                        cached.get("strip_images") or [],
+                        cached.get("strip_tiles") or [],
                     )
-                    copy_failed = True
-
-            # If we failed to do ghostscript compression, just make a copy
-            if copy_failed:
+                ]
+                page_text_path = cached.get("page_text")
+                text_index = cached.get("text_index")
+                duplicate_pages = cached.get("duplicate_pages", 0)
+                pdf_linearized = cached.get("pdf_linearized", False)
+                complete = True
+            else:
+                # Process the PDF file
+                with timings.stage("inspect"):
+                    pdf_info = inspect_pdf(
+                        file_path,
+                        int(settings["preview_width"]),
+                        bool(settings["dedupe_pages"]),
+                    )
+                num_pages = pdf_info["num_pages"]
                 logger.debug(
-                    "Ghostscript compression of PDF failed, making a plain copy"
+                    "Inspected %d pages (peak RSS %8.2f MB)"
+                    % (num_pages, peak_rss_mb())
                 )
-                shutil.copyfile(file_path, preview_path)
 
-            # Upload the preview
-            preview_id = upload_preview(
-                connector, host, secret_key, file_id, preview_path, None
-            )
+                pdf_linearized = create_preview_pdf(
+                    pdf_info,
+                    file_path,
+                    preview_path,
+                    bool(settings["linearize_preview"]),
+                    timings,
+                )
 
-            # Also create and upload a preview image
-            # gs -dNOPAUSE -q -sDEVICE=png256 -r500 -dBATCH -dFirstPage=1 -dLastPage=1 -sOutputFile=out.png in.pdf
-            preview_image_ids = []
-            sum_preview_image_sizes = 0
-            try:
-                png_preview_path = os.path.join(tempdir, "temp.png")
-                for page in range(len(reader.pages)):
-                    page_num = page + 1
-                    webp_preview_path = os.path.join(
-                        tempdir, "page_%03d.webp" % page_num
-                    )
-                    subprocess.check_call(
-                        [
-                            "gs",
-                            "-sDEVICE=png256",
-                            "-r500",
-                            "-dFirstPage=%d" % page_num,
-                            "-dLastPage=%d" % page_num,
-                            "-dNOPAUSE",
-                            "-dQUIET",
-                            "-dBATCH",
-                            "-sOutputFile=%s" % png_preview_path,
-                            file_path,
-                        ]
-                    )
-                    subprocess.check_call(
-                        [
-                            "convert",
-                            "-resize",
-                            "512X",
-                            png_preview_path,
-                            png_preview_path,
-                        ]
+                # Upload the preview
+                preview_index = uploader.put(preview_path)
+
+                # Very long documents only get previews up to a maximum number of pages
+                max_preview_pages = int(settings["max_preview_pages"])
+                preview_pages = num_pages
+                if 0 < max_preview_pages < num_pages:
+                    logger.debug(
+                        "Only creating previews of the first %d of %d pages"
+                        % (max_preview_pages, num_pages)
                     )
-                    subprocess.check_call(
-                        ["cwebp", "-quiet", png_preview_path, "-o", webp_preview_path]
+                    preview_pages = max_preview_pages
+
+                # The text of the pages is extracted along with the previews
+                page_text = None
+                if settings["extract_text"]:
+                    page_text = PageTextCollector(
+                        os.path.join(tempdir, "page_text.txt")
                     )
-                    # Upload the webp preview
-                    preview_image_ids.append(
-                        upload_preview(
+                # Sprite sheets come with a low resolution strip of all pages, from thumbnails made along the way
+                thumbnails = None
+                if int(settings["sprite_sheet_pages"]) > 0 and int(
+                    settings["strip_width"]
+                ):
+                    thumbnails = []
+                # Pages that look the same as a page we rendered before (in any batch) share its preview
+                rendered_pages = {}
+
+                # Start with a first batch of pages, which we publish right away so a preview is available
+                # while we work on the rest of the document
+                first_batch_pages = max(1, int(settings["first_batch_pages"]))
+                first_batch_pages = min(first_batch_pages, preview_pages)
+                preview_images, complete = self.queue_page_previews(
+                    pdf_info,
+                    file_path,
+                    tempdir,
+                    settings,
+                    uploader,
+                    1,
+                    first_batch_pages,
+                    page_text,
+                    thumbnails,
+                    rendered_pages,
+                    timings,
+                )
+                if complete and first_batch_pages < preview_pages:
+                    with timings.stage("upload_wait"):
+                        preview_ids = uploader.wait()
+                    with timings.stage("metadata_upload"):
+                        self.upload_previews_metadata(
                             connector,
                             host,
                             secret_key,
                             file_id,
-                            webp_preview_path,
-                            None,
+                            preview_path,
+                            num_pages,
+                            preview_ids[preview_index],
+                            [
+                                (preview_ids[index], path, tile)
+                                for index, path, tile in preview_images
+                            ],
+                            {"pdf_linearized": pdf_linearized},
                         )
+                    partial_metadata = True
+                    more_preview_images, complete = self.queue_page_previews(
+                        pdf_info,
+                        file_path,
+                        tempdir,
+                        settings,
+                        uploader,
+                        first_batch_pages + 1,
+                        preview_pages,
+                        page_text,
+                        thumbnails,
+                        rendered_pages,
+                        timings,
                     )
-                    sum_preview_image_sizes += os.stat(webp_preview_path).st_size / 1024
-            except subprocess.CalledProcessError as e:
-                logging.getLogger().exception("Create of preview image failed!")
-
-            # Check whether landscape
-            # identify -format '%w %h' test.png | awk '{if ($1<$2) {exit 1} else {exit 0} }'
-
-            # Create and save metadata as well
-            result = {
-                "preview_pdf": preview_id,
-                "num_pages": len(reader.pages),
-                "preview_images": preview_image_ids,
-                "preview_images_size_kb": sum_preview_image_sizes,
-                "pdf_size_mb": os.stat(preview_path).st_size / (1024 * 1024),
-            }
-            
-            # Create the metadata entry based on our 'result' dict and upload it
-            metadata = self.get_metadata(result, "file", file_id, host)
-            upload_metadata(connector, host, secret_key, file_id, metadata)
-
-            # Perform additional PDF processing
-            # Add your code here to extract text, images, or perform other operations on the PDF
-
-            # Example: Notify success
-            logger.debug(
-                "PDF extraction complete (previews: PDF %8.2f MB, Images %8.2f KB)!"
-                % (result["pdf_size_mb"], result["preview_images_size_kb"])
+                    preview_images += more_preview_images
+
+                strip_images = []
+                if thumbnails:
+                    with timings.stage("strip"):
+                        strip_tiles = save_sprite_sheets(
+                            thumbnails,
+                            tempdir,
+                            "strip",
+                            list(range(1, len(thumbnails) + 1)),
+                            WEBP_MAX_DIMENSION,
+                            int(settings["preview_quality"]),
+                        )
+                    strip_images = [
+                        (uploader.put_once(strip_path), strip_path, tile)
+                        for strip_path, tile in strip_tiles
+                    ]
+
+                # Count the pages that got the preview of an earlier page
+                fingerprints = [
+                    fingerprint
+                    for fingerprint in pdf_info["page_fingerprints"][
+                        : len(preview_images)
+                    ]
+                    if fingerprint is not None
+                ]
+                duplicate_pages = len(fingerprints) - len(set(fingerprints))
+
+                page_text_path = None
+                text_index = None
+                if page_text is not None:
+                    page_text.close()
+                    page_text_path = page_text.text_path
+                    text_index = page_text.index(
+                        int(settings["text_index_max_terms"]),
+                        int(settings["text_index_max_pages"]),
+                    )
+
+            # Upload the text of the pages next to the previews
+            if page_text_path:
+                page_text_index = uploader.put(page_text_path)
+        finally:
+            with timings.stage("upload_wait"):
+                preview_ids = uploader.join()
+
+        preview_id = preview_ids[preview_index]
+        preview_images = [
+            (preview_ids[index], path, tile) for index, path, tile in preview_images
+        ]
+        strip_images = [
+            (preview_ids[index], path, tile) for index, path, tile in strip_images
+        ]
+        extra_results = {
+            "pdf_linearized": pdf_linearized,
+            "duplicate_pages": duplicate_pages,
+            "dedupe_ratio": duplicate_pages / float(max(1, len(preview_images))),
+        }
+        if strip_images:
+            extra_results["strip_images"] = [
+                strip_image_id for strip_image_id, _, _ in strip_images
+            ]
+            extra_results["strip_tiles"] = [tile for _, _, tile in strip_images]
+        if page_text_path:
+            extra_results["text_preview"] = preview_ids[page_text_index]
+            extra_results["text_index"] = text_index
+
+        # Only keep complete sets of previews for later
+        if cache_key and not cached and complete:
+            with timings.stage("cache_store"):
+                cache_store(
+                    cache_key,
+                    {
+                        "preview_pdf": preview_path,
+                        "preview_images": [path for _, path, _ in preview_images],
+                        "preview_tiles": [tile for _, _, tile in preview_images],
+                        "strip_images": [path for _, path, _ in strip_images],
+                        "strip_tiles": [tile for _, _, tile in strip_images],
+                        "page_text": page_text_path,
+                        "text_index": text_index,
+                        "duplicate_pages": duplicate_pages,
+                        "pdf_linearized": pdf_linearized,
+                        "num_pages": num_pages,
+                    },
+                )
+
+        # Check whether landscape
+        # identify -format '%w %h' test.png | awk '{if ($1<$2) {exit 1} else {exit 0} }'
+
+        # Machine readable record of where the time went, for every document
+        stats = {
+            "file_id": file_id,
+            "file_mb": round(os.stat(file_path).st_size / (1024 * 1024), 3),
+            "num_pages": num_pages,
+            "preview_pages": len(preview_images),
+            "uploads": len(preview_ids),
+            "cached": bool(cached),
+            "seconds": round(time.monotonic() - start, 3),
+            "stages": timings.as_dict(),
+            "peak_rss_mb": round(peak_rss_mb(), 2),
+            "peak_child_rss_mb": round(timings.child_peak_mb, 2),
+        }
+        if settings["stats_in_metadata"]:
+            extra_results["extraction_stats"] = stats
+
+        # Create and save metadata as well
+        with timings.stage("metadata_upload"):
+            result = self.upload_previews_metadata(
+                connector,
+                host,
+                secret_key,
+                file_id,
+                preview_path,
+                num_pages,
+                preview_id,
+                preview_images,
+                extra_results,
+                replace=partial_metadata,
+            )
+
+        # Perform additional PDF processing
+        # Add your code here to extract images, or perform other operations on the PDF
+
+        # Example: Notify success
+        logger.debug(
+            "PDF extraction complete (previews: PDF %8.2f MB, Images %8.2f KB)!"
+            % (result["pdf_size_mb"], result["preview_images_size_kb"])
+        )
+        stats = dict(
+            stats,
+            seconds=round(time.monotonic() - start, 3),
+            stages=timings.as_dict(),
+        )
+        logger.info("Extraction stats: %s" % json.dumps(stats, sort_keys=True))
+
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+    def upload_previews_metadata(
+        self,
+        connector,
+        host,
+        secret_key,
+        file_id,
+        preview_path,
+        num_pages,
+        preview_id,
+        preview_images,
+        extra_results=None,
+        replace=False,
+    ):
+        """
+        Upload the metadata describing the previews. This can happen more than once for a file, with every upload
+        covering more of its pages, the final upload replaces the earlier ones. Should removing those fail, the file
+        has several entries of ours and the one that was created last (with "preview_complete" true, unless there
+        are more pages than max_preview_pages) is the one that counts.
+
+        :param preview_images: list of (preview ID, path, tile) of the page previews, starting from the first page.
+        The tile is the [x, y, width, height] of the page in a sprite sheet (that the pages in it share), or None if
+        the preview is just the page.
+        :param extra_results: dict with any other results to add to the metadata
+        :param replace: whether to remove the metadata we uploaded before for this file
+        :return: the metadata content
+        """
+        result = {
+            "preview_pdf": preview_id,
+            "num_pages": num_pages,
+            "preview_images": [
+                preview_image_id for preview_image_id, _, _ in preview_images
+            ],
+            # Page previews always start from the first page, but may not (yet) cover the whole document
+            "preview_pages": list(range(1, len(preview_images) + 1)),
+            "preview_complete": len(preview_images) == num_pages,
+            "preview_images_size_kb": sum(
+                os.stat(webp_preview_path).st_size / 1024
+                for webp_preview_path in set(path for _, path, _ in preview_images)
+            ),
+            "pdf_size_mb": os.stat(preview_path).st_size / (1024 * 1024),
+        }
+        if any(tile for _, _, tile in preview_images):
+            # The viewer shows the pages as these parts of the sprite sheets
+            result["preview_tiles"] = [tile for _, _, tile in preview_images]
+        if extra_results:
+            result.update(extra_results)
+
+        # Create the metadata entry based on our 'result' dict and upload it
+        metadata = self.get_metadata(result, "file", file_id, host)
+        if replace:
+            self.remove_previews_metadata(connector, host, secret_key, file_id)
+        upload_metadata(connector, host, secret_key, file_id, metadata)
+
+        return result
+
+    def remove_previews_metadata(self, connector, host, secret_key, file_id):
+        """
+        Remove the metadata this extractor uploaded for a file (pyclowder has no call for it). Failing to do so is
+        logged, but not fatal: it only leaves an outdated entry next to the new one.
+        """
+        logger = logging.getLogger(__name__)
+        url = "%s/api/files/%s/metadata.jsonld" % (host.rstrip("/"), file_id)
+        try:
+            response = connector.delete(
+                url,
+                raise_status=False,
+                params={"key": secret_key, "extractor": self.extractor_info["name"]},
+                verify=connector.ssl_verify if connector else True,
             )
+        except IOError as err:
+            logger.warning(
+                "Failed to remove earlier metadata of %s: %s" % (file_id, err)
+            )
+            return
+        if not response.ok:
+            logger.warning(
+                "Failed to remove earlier metadata of %s (HTTP status %d)"
+                % (file_id, response.status_code)
+            )
+
+    def queue_page_previews(
+        self,
+        pdf_info,
+        file_path,
+        tempdir,
+        settings,
+        uploader,
+        first_page,
+        last_page,
+        page_text=None,
+        thumbnails=None,
+        rendered_pages=None,
+        timings=None,
+    ):
+        """
+        Create a preview image for the pages first_page..last_page and queue them for upload. If a PageTextCollector
+        is given, the text of the pages is extracted by the same workers (that have the pages at hand anyway) and
+        added to it. If a list of thumbnails is given, thumbnails of the pages (for the low resolution strip) are
+        added to it.
+
+        With sprite sheets, every range of pages is a sheet, which saves an upload (and a request from the viewer)
+        for every page.
+
+        Ghostscript renders a whole range of pages in a single run (so the document is only parsed once per range),
+        at the resolution that gives the preview width for the page size, and streams them to us to encode as WebP:
+        gs -dNOPAUSE -q -sDEVICE=ppmraw -r62.06 -dBATCH -dFirstPage=1 -dLastPage=50 -sOutputFile=- in.pdf
+        The ranges are independent, so they are spread over a pool of worker processes. Pages with the same
+        fingerprint as a page that was rendered before are left out of the ranges, they get the preview (and the
+        thumbnail and text) of that page.
+
+        :param rendered_pages: dict of the fingerprints of the pages rendered so far with their preview, thumbnail
+        and text (to share them between calls), gets updated
+        :param timings: StageTimings to add the time spent in every stage of the workers to
+        :return: list of (upload index, path, tile) of the page previews in page order (pages in a sprite sheet
+        share its upload index and path, and have their tile in it), and whether all pages made it
+        """
+        logger = logging.getLogger(__name__)
+
+        preview_images = []
+        if rendered_pages is None:
+            rendered_pages = {}
+        if timings is None:
+            timings = StageTimings()
+        preview_width = int(settings["preview_width"])
+        preview_quality = int(settings["preview_quality"])
+        sprite_sheet_pages = max(0, int(settings["sprite_sheet_pages"]))
+        sprite_columns = 0
+        if sprite_sheet_pages:
+            sprite_columns = max(1, int(settings["sprite_sheet_columns"]))
+        strip_width = 0
+        if thumbnails is not None:
+            strip_width = int(settings["strip_width"])
+
+        # Only render the first of the pages that look the same
+        page_fingerprints = pdf_info["page_fingerprints"]
+        render_page_nums = []
+        fingerprints = set(rendered_pages)
+        for page_num in range(first_page, last_page + 1):
+            fingerprint = page_fingerprints[page_num - 1]
+            if fingerprint is None or fingerprint not in fingerprints:
+                render_page_nums.append(page_num)
+                fingerprints.add(fingerprint)
+        # Scanned pages get their preview from the embedded image, the others are rendered by Ghostscript
+        page_modes = [
+            pdf_info["page_modes"][page_num - 1] for page_num in render_page_nums
+        ]
+        workers = int(settings["preview_workers"]) or available_cpus()
+        workers = max(1, min(workers, len(render_page_nums)))
+        page_ranges = split_page_ranges(
+            render_page_nums, page_modes, workers, sprite_sheet_pages
+        )
+        logger.debug(
+            "Rendering %d pages (%d scanned, %d duplicates skipped) in %d ranges using %d workers"
+            % (
+                len(render_page_nums),
+                sum(1 for scanned, _ in page_modes if scanned),
+                last_page - first_page + 1 - len(render_page_nums),
+                len(page_ranges),
+                workers,
+            )
+        )
+
+        def add_page(page_num, preview, thumbnail, text):
+            preview_images.append(preview)
+            if thumbnails is not None:
+                thumbnails.append(thumbnail)
+            if page_text is not None:
+                page_text.add(page_num, text)
+            fingerprint = page_fingerprints[page_num - 1]
+            if fingerprint is not None and fingerprint not in rendered_pages:
+                rendered_pages[fingerprint] = (preview, thumbnail, text)
+
+        # Ranges of different modes interleave, so pages can come back before the pages in front of them. They
+        # are kept here until it is their turn.
+        finished_pages = {}
+        render_pages_set = set(render_page_nums)
+        next_page = first_page
+
+        def add_finished_pages():
+            nonlocal next_page
+            while next_page <= last_page:
+                if next_page in finished_pages:
+                    add_page(next_page, *finished_pages.pop(next_page))
+                elif next_page not in render_pages_set:
+                    # A duplicate of a page we have done already
+                    add_page(
+                        next_page, *rendered_pages[page_fingerprints[next_page - 1]]
+                    )
+                else:
+                    return
+                next_page += 1
+
+        try:
+            # Workers that need to read the document (rather than just have Ghostscript render its pages) open it
+            # once, for all their ranges
+            pool_initializer = None
+            if page_text is not None or any(scanned for scanned, _ in page_modes):
+                pool_initializer = open_worker_pdf
+            with timings.stage("previews"), multiprocessing.Pool(
+                workers, pool_initializer, (file_path,)
+            ) as pool:
+                # The ranges come back in order of their first page, as soon as each one is ready. Rendering
+                # doesn't run more than a couple of ranges ahead of the uploads.
+                for (page_nums, _), (
+                    previews,
+                    range_thumbnails,
+                    page_texts,
+                    range_timings,
+                    range_child_peak_mb,
+                ) in zip(
+                    page_ranges,
+                    bounded_imap(
+                        pool,
+                        create_page_previews,
+                        [
+                            (
+                                file_path,
+                                tempdir,
+                                page_nums,
+                                mode,
+                                preview_width,
+                                preview_quality,
+                                page_text is not None,
+                                sprite_columns,
+                                strip_width,
+                            )
+                            for page_nums, mode in page_ranges
+                        ],
+                        2 * workers,
+                    ),
+                ):
+                    for index, page_num in enumerate(page_nums):
+                        webp_preview_path, tile = previews[index]
+                        finished_pages[page_num] = (
+                            # Queue the webp preview for upload (waits if the uploads can't keep up)
+                            (
+                                uploader.put_once(webp_preview_path),
+                                webp_preview_path,
+                                tile,
+                            ),
+                            range_thumbnails[index] if range_thumbnails else None,
+                            page_texts[index] if page_texts else "",
+                        )
+                    add_finished_pages()
+                    timings.update(range_timings, range_child_peak_mb)
+            add_finished_pages()
+        except (subprocess.CalledProcessError, ValueError) as e:
+            logging.getLogger().exception("Create of preview image failed!")
+            return preview_images, False
+
+        return preview_images, True
 
 
 if __name__ == "__main__":
@@ -0,0 +1,371 @@
+"""
+Check of the slide detection of the presentation extractor against a reference clip. It generates a synthetic talk
+(slides with text, a chart, coloured boxes that change colour only, a speaker in the masked corner, a mouse pointer
+and sensor noise, compressed to mp4) with known transitions and finds the slides in it:
+    - with analysis_fps and analysis_width set to 0, which analyses every frame in BGR as the extractor always did
+      (the baseline),
+    - with the default settings (sampled, downscaled grayscale frames).
+The transitions of the defaults must match those of the baseline, to within one analysed frame, the baseline
+must find the transitions the clip has, and both the segments detected in parallel and a detection interrupted and
+resumed from its checkpoint must find the same transitions as a single pass over the video. Run it before changing
+the defaults of the detection:
+    python check_detection.py
+Use --setting to check other settings of the detection, e.g. --setting analysis_fps=10
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import cv2  # OpenCV
+import numpy as np
+
+import presentation_extractor
+
+# Size, frame rate and length of the reference clip
+CLIP_SIZE = (1280, 720)
+CLIP_FPS = 30
+CLIP_SECONDS = 170
+# Seconds at which the slides of the reference clip change
+CLIP_TRANSITIONS = [0, 30, 55, 80, 110, 130]
+# Mask of the extractor's default settings, over the speaker
+CLIP_MASKS = [{"location": "bottom-right", "size_x": "20%", "size_y": "20%"}]
+
+
+def draw_text(image, text, origin, scale=1.0, color=(0, 0, 0), thickness=2):
+    cv2.putText(
+        image,
+        text,
+        origin,
+        cv2.FONT_HERSHEY_SIMPLEX,
+        scale,
+        color,
+        thickness,
+        cv2.LINE_AA,
+    )
+
+
+def titled_slide(title):
+    """An empty slide with a title bar"""
+    slide = np.full((CLIP_SIZE[1], CLIP_SIZE[0], 3), 255, np.uint8)
+    cv2.rectangle(slide, (0, 0), (CLIP_SIZE[0], 90), (120, 60, 20), -1)
+    draw_text(slide, title, (40, 62), 1.5, (255, 255, 255), 3)
+    return slide
+
+
+def boxes_slide(colors):
+    """A slide with six coloured boxes"""
+    slide = titled_slide("Architecture")
+    for index, color in enumerate(colors):
+        x = 80 + 400 * (index % 3)
+        y = 150 + 230 * (index // 3)
+        cv2.rectangle(slide, (x, y), (x + 300, y + 160), color, -1)
+        draw_text(
+            slide, "Stage %d" % (index + 1), (x + 70, y + 90), 1.1, (255, 255, 255)
+        )
+    return slide
+
+
+def reference_slides():
+    """The slides of the reference clip, one for every transition"""
+    title = np.full((CLIP_SIZE[1], CLIP_SIZE[0], 3), 255, np.uint8)
+    cv2.rectangle(title, (0, 200), (CLIP_SIZE[0], 420), (120, 60, 20), -1)
+    draw_text(
+        title, "Slide detection in recorded talks", (80, 320), 2.0, (255, 255, 255), 4
+    )
+    draw_text(title, "A. Speaker - Example Workshop", (80, 390), 1.0, (230, 230, 230))
+
+    outline = titled_slide("Outline")
+    for index, line in enumerate(
+        ["Motivation", "Background subtraction", "Averaging", "Triggers", "Results"]
+    ):
+        draw_text(outline, "- " + line, (80, 170 + 60 * index), 1.1)
+
+    # Same title, other text and a chart
+    chart = titled_slide("Outline")
+    for index, line in enumerate(["Sampling", "Downscaling", "Colour"]):
+        draw_text(chart, "- " + line, (80, 170 + 60 * index), 1.1, (120, 40, 0))
+    for index, (bar_height, color) in enumerate(
+        [
+            (250, (40, 40, 220)),
+            (180, (40, 180, 40)),
+            (320, (200, 120, 40)),
+            (120, (0, 160, 230)),
+        ]
+    ):
+        cv2.rectangle(
+            chart,
+            (600 + 130 * index, 560 - bar_height),
+            (700 + 130 * index, 560),
+            color,
+            -1,
+        )
+
+    # The same boxes, then in other colours whose gray levels are only about 9 higher, which a threshold too coarse
+    # for grayscale does not see
+    boxes = boxes_slide(
+        [
+            (200, 120, 40),
+            (40, 160, 200),
+            (60, 180, 60),
+            (180, 80, 160),
+            (90, 90, 200),
+            (30, 140, 220),
+        ]
+    )
+    recoloured_boxes = boxes_slide(
+        [
+            (10, 70, 240),
+            (230, 240, 0),
+            (230, 70, 240),
+            (10, 210, 0),
+            (230, 180, 0),
+            (250, 220, 10),
+        ]
+    )
+
+    conclusions = titled_slide("Conclusions")
+    for index, line in enumerate(
+        [
+            "Sampling is enough",
+            "Grayscale loses colour",
+            "Thresholds depend on the size",
+            "Questions?",
+        ]
+    ):
+        draw_text(conclusions, "* " + line, (80, 180 + 70 * index), 1.2, (40, 40, 40))
+
+    return [title, outline, chart, boxes, recoloured_boxes, conclusions]
+
+
+def make_clip(clip_path):
+    """Write the reference clip"""
+    rng = np.random.RandomState(0)
+    noise = [
+        rng.normal(0, 2.0, (CLIP_SIZE[1], CLIP_SIZE[0], 3)).astype(np.int16)
+        for _ in range(8)
+    ]
+    slides = reference_slides()
+    writer = cv2.VideoWriter(
+        clip_path, cv2.VideoWriter_fourcc(*"mp4v"), CLIP_FPS, CLIP_SIZE
+    )
+    width, height = CLIP_SIZE
+    for frame_index in range(CLIP_FPS * CLIP_SECONDS):
+        seconds = frame_index / float(CLIP_FPS)
+        slide = max(
+            index
+            for index, transition in enumerate(CLIP_TRANSITIONS)
+            if seconds >= transition
+        )
+        frame = slides[slide].copy()
+        # The speaker, in the corner that gets masked
+        cv2.rectangle(
+            frame, (width - 256, height - 144), (width, height), (70, 90, 110), -1
+        )
+        head = (
+            int(width - 128 + 30 * np.sin(seconds * 1.3)),
+            int(height - 80 + 10 * np.sin(seconds * 2.1)),
+        )
+        cv2.circle(frame, head, 35, (150, 170, 200), -1)
+        cv2.circle(frame, (head[0], head[1] + 70), 55, (40, 40, 120), -1)
+        # A mouse pointer now and then
+        if 60 <= seconds < 66 or 140 <= seconds < 155:
+            x = int(300 + 500 * ((seconds * 0.2) % 1))
+            y = int(250 + 150 * np.sin(seconds))
+            pointer = np.array([(x, y), (x, y + 24), (x + 7, y + 18), (x + 16, y + 18)])
+            cv2.fillPoly(frame, [pointer], (0, 0, 0))
+        frame = np.clip(frame.astype(np.int16) + noise[frame_index % 8], 0, 255)
+        writer.write(frame.astype(np.uint8))
+    writer.release()
+
+
+class CheckExtractor(presentation_extractor.VideoMetaData):
+    """The presentation extractor without a connection to Clowder"""
+
+    def __init__(self, tempdir):
+        # Skip the setup of pyclowder (command line arguments, connecting to RabbitMQ)
+        self.logger = logging.getLogger(presentation_extractor.__name__)
+        self.tempdir = tempdir
+
+
+class StubConnector:
+    """Drops the progress messages"""
+
+    def message_process(self, resource, message):
+        pass
+
+
+def find_slides(clip_path, settings):
+    """
+    Find the slides in the clip
+
+    :return: tuple of the list of frame numbers and timestamps of the transitions and the seconds it took
+    """
+    tempdir = tempfile.mkdtemp(prefix="check-detection")
+    start = time.time()
+    slides = CheckExtractor(tempdir).slide_find_advanced(
+        clip_path, StubConnector(), {"id": "reference"}, masks=CLIP_MASKS, **settings
+    )
+    seconds = time.time() - start
+    # The last entry only holds the end of the video
+    return [(frame, timestamp) for frame, timestamp, _ in slides[:-1]], seconds
+
+
+class Interrupted(Exception):
+    """The detection got interrupted, like a worker that gets killed"""
+
+
+def find_slides_resumed(clip_path, settings, stop_frame):
+    """
+    Find the slides in the clip, interrupting the detection right after it saved its progress at stop_frame and then
+    resuming it from that checkpoint
+
+    :return: tuple of the list of frame numbers and timestamps of the transitions and the seconds it took
+    """
+    settings = dict(
+        settings,
+        checkpoint_dir=tempfile.mkdtemp(prefix="check-detection"),
+        # Save the progress at every frame
+        checkpoint_interval=1e-9,
+    )
+    write_checkpoint = presentation_extractor.write_checkpoint
+
+    def interrupt(checkpoint, state):
+        write_checkpoint(checkpoint, state)
+        if not state["done"] and state["frame_index"] >= stop_frame:
+            raise Interrupted()
+
+    presentation_extractor.write_checkpoint = interrupt
+    try:
+        find_slides(clip_path, settings)
+    except Interrupted:
+        pass
+    finally:
+        presentation_extractor.write_checkpoint = write_checkpoint
+    return find_slides(clip_path, settings)
+
+
+def transitions_match(transitions, reference, tolerance):
+    """Whether every transition is within tolerance frames of the one of the reference"""
+    return len(transitions) == len(reference) and all(
+        abs(frame - reference_frame) <= tolerance
+        for (frame, _), (reference_frame, _) in zip(transitions, reference)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument(
+        "--workdir",
+        help="directory for the reference clip (it is kept, and reused by later runs), default a temporary directory",
+    )
+    parser.add_argument(
+        "--setting",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="setting of the detection to check (the value is parsed as JSON)",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    settings = {}
+    for setting in args.setting:
+        key, _, value = setting.partition("=")
+        settings[key] = json.loads(value)
+    options = dict(presentation_extractor.default_settings_advanced, **settings)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="check-detection")
+    clip_path = os.path.join(workdir, "reference.mp4")
+    if not os.path.exists(clip_path):
+        make_clip(clip_path)
+
+    baseline_settings = dict(
+        settings,
+        analysis_fps=0,
+        analysis_width=0,
+        detection_workers=1,
+        shared_decode=False,
+    )
+    baseline, baseline_seconds = find_slides(clip_path, baseline_settings)
+    checks = [
+        (
+            "baseline finds the transitions of the clip",
+            baseline,
+            [
+                (transition * CLIP_FPS, transition * 1000.0)
+                for transition in CLIP_TRANSITIONS
+            ],
+            1,
+            baseline_seconds,
+        )
+    ]
+
+    # Transitions can only be found at analysed frames
+    analysis_fps = options.get("analysis_fps") or CLIP_FPS
+    tolerance = int(np.ceil(CLIP_FPS / float(min(analysis_fps, CLIP_FPS))))
+    defaults, defaults_seconds = find_slides(
+        clip_path, dict(settings, detection_workers=1, shared_decode=False)
+    )
+    checks.append(
+        ("settings match the baseline", defaults, baseline, tolerance, defaults_seconds)
+    )
+
+    # Interrupt the detection at a few points, right after a transition and before the next one included
+    for stop_seconds in [35, 88, 115, 128]:
+        resumed, resumed_seconds = find_slides_resumed(
+            clip_path,
+            dict(settings, detection_workers=1, shared_decode=False),
+            stop_seconds * CLIP_FPS,
+        )
+        checks.append(
+            (
+                "resumed at %d s matches one pass" % stop_seconds,
+                resumed,
+                defaults,
+                0,
+                resumed_seconds,
+            )
+        )
+
+    # Segments are at least 10 minimum slide lengths, with these they start every 30 seconds, so the transition at
+    # 30 seconds is the first frame of a segment
+    segment_settings = dict(
+        settings,
+        minimum_slide_length=3,
+        motion_capture_averaging_time=3,
+        shared_decode=False,
+    )
+    serial, _ = find_slides(clip_path, dict(segment_settings, detection_workers=1))
+    parallel, parallel_seconds = find_slides(
+        clip_path,
+        dict(segment_settings, detection_workers=int(np.ceil(CLIP_SECONDS / 30.0))),
+    )
+    checks.append(
+        ("segments in parallel match one pass", parallel, serial, 0, parallel_seconds)
+    )
+
+    failed = False
+    for name, transitions, reference, check_tolerance, seconds in checks:
+        ok = transitions_match(transitions, reference, check_tolerance)
+        failed = failed or not ok
+        print(
+            "%-50s %s (%6.1f s): %s"
+            % (
+                name,
+                "ok  " if ok else "FAIL",
+                seconds,
+                ", ".join(
+                    "%.1f s" % (timestamp / 1000.0) for _, timestamp in transitions
+                ),
+            )
+        )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
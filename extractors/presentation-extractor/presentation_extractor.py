@@ -6,13 +6,21 @@ Author Ward Poelmans <wpoely86@gmail.com>
 Author Alan O'Cais <alan.ocais@cecam.org>
 """
 
+import collections
+import concurrent.futures
 import datetime
+import fcntl
+import hashlib
+import json
 import logging
+import math
 import multiprocessing
 import os
 import shutil
+import struct
 import subprocess
 import tempfile
+import threading
 import time
 
 import cv2  # OpenCV
@@ -86,73 +94,1030 @@ default_settings_advanced = {
     "motion_capture_averaging_time": 10,
     # Amount of time to delay a screenshot (slide transitions can mean bad screenshots)
     "msec_to_delay_screenshot": 800,
+    # Number of frames per second that get analysed, the frames in between are skipped (0 means every frame)
+    "analysis_fps": 5,
+    # Width (in pixels) the frames are scaled down to (in grayscale) before they get analysed (0 means the full
+    # resolution)
+    "analysis_width": 640,
+    # Number of processes that find the slides in parallel, each in a part of the video (0 means half of the
+    # available cores)
+    "detection_workers": 0,
+    # Find the slides in the frames the preview encoder decodes (in a single process) instead of decoding the video
+    # once more. A redelivered file whose previews were done gets the same frames from a decoder.
+    "shared_decode": True,
+    # Number of threads OpenCV may use in every detection process (unset means the share of the CPUs of a detection
+    # process, see default_settings_resources, 0 means the OpenCV default)
+    "opencv_threads": None,
 }
 
+# Squared distance threshold of the background subtractor for the BGR frames (the OpenCV default), and for the
+# downscaled grayscale frames. Grayscale is blind to part of a change in colour and downscaling averages out the
+# noise as well as thin strokes of text, so the threshold for a single gray channel is lower than the 400 / 3 that
+# matches a neutral change of the BGR frames. Calibrated with check_detection.py.
+KNN_DIST2_THRESHOLD_BGR = 400.0
+KNN_DIST2_THRESHOLD_GRAY = 400.0 / 9
+# Number of samples of the KNN background subtractor (the OpenCV default)
+KNN_SAMPLES = 7
+
+
+def knn_update_interval(history):
+    """
+    Number of frames between updates of the short term model of the KNN background subtractor with the given history
+    (as worked out in OpenCV's bgfg_KNN.cpp). This sets how fast a new slide becomes the background.
+    """
+    if history < 2:
+        return 1
+    short_term = int(math.log(0.7) / math.log(1.0 - 1.0 / history)) + 1
+    return short_term // KNN_SAMPLES + 1
+
+
+def knn_history(averaging_time, analysis_fps, fps):
+    """
+    History (in analysed frames) of the KNN background subtractor for frames sampled at analysis_fps. The history of
+    averaging_time seconds makes the model learn a new background in steps that get rounded to whole analysed
+    frames, later than when every frame is analysed. That inflates the average after a transition (and hides the
+    next one), so the history gets shortened until the model learns at least as fast as with every frame.
+    """
+    full_rate_interval = knn_update_interval(int(averaging_time * fps)) / float(fps)
+    history = max(1, int(averaging_time * analysis_fps))
+    while (
+        knn_update_interval(history) > 1
+        and knn_update_interval(history) / float(analysis_fps) > full_rate_interval
+    ):
+        history -= 1
+    return history
+
+
+default_settings_previews = {
+    # How to encode the previews: single_pass (constant quality, capped bitrate, all previews from one decode of
+    # the video) or two_pass (average bitrate, every pass decodes the video)
+    "encoding_mode": "single_pass",
+    # Constant rate factor (quality) of the mp4 preview in single pass mode, the bitrate is capped at 250k
+    "mp4_crf": 30,
+    # Number of threads for the encoders (0 means half of the available cores)
+    "encoding_threads": 0,
+    # Videos that already are web friendly H.264 (with AAC audio) up to this video bitrate (in bits per second) and
+    # resolution get copied into the mp4 preview instead of encoded (a bitrate of 0 means always encode)
+    "remux_max_bitrate": 250000,
+    "remux_max_width": 1920,
+    "remux_max_height": 1080,
+}
+
+# H.264 profiles that all browsers can play
+WEB_H264_PROFILES = ["Constrained Baseline", "Baseline", "Main", "High"]
+
 default_settings_basic = {
     "threshold_cutoff": 115,
     "trigger": 0.01,
 }
 
+default_settings_resources = {
+    # Number of CPUs the extractor may use (0 means the CPU quota of the container, rounded down, or the cores it may
+    # run on if there are less)
+    "cpus": 0,
+    # Part of the CPUs that goes to the preview encoder, the rest is for the slide detection
+    "encoding_share": 0.5,
+    # Memory (in MiB) a detection worker needs, the memory limit of the container caps the number of workers
+    "detection_worker_memory": 512,
+    # Number of threads uploading the slides while the previews are still being encoded
+    "upload_threads": 4,
+    # Directory to keep the progress of the slide detection and the encoded previews in, so a redelivered file
+    # resumes where the previous attempt stopped (empty means a directory in the temp dir). Only a directory on a
+    # persistent volume survives a redeploy of the extractor.
+    "checkpoint_dir": "",
+    # Number of seconds between checkpoints of the slide detection (0 means no checkpoints)
+    "checkpoint_interval": 60,
+    # Number of hours after which the checkpoints of files that never got redelivered are removed
+    "checkpoint_max_age": 48,
+}
+
+
+def lock_checkpoint_dir(checkpoint_dir):
+    """
+    Take an exclusive lock on a checkpoint directory, so only one attempt at a file uses it at a time. After a
+    missed heartbeat the original worker is usually still at it when the redelivered message starts.
+
+    :return: the open lock file (closing it releases the lock), or None if another process holds the lock
+    """
+    lock_path = os.path.join(checkpoint_dir, ".lock")
+    try:
+        lock_file = open(lock_path, "a")
+    except (IOError, OSError):
+        return None
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # The process that held the lock removes the directory when it is done, we may have locked a lock file
+        # that is gone by now
+        if os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+            return lock_file
+    except (IOError, OSError):
+        pass
+    lock_file.close()
+    return None
+
+
+def read_cgroup_file(path):
+    """Read the first line of a cgroup file, returns None if it doesn't exist"""
+    try:
+        with open(path, "r") as cgroup_file:
+            return cgroup_file.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def cgroup_cpu_limit():
+    """Get the CPU quota (in CPUs) of the cgroup we run in (v2 or v1), returns None if there is no quota"""
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    cpu_max = read_cgroup_file("/sys/fs/cgroup/cpu.max")
+    if cpu_max:
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max" and period:
+            return int(quota) / float(period)
+        return None
+    # cgroup v1: a quota of -1 means no quota
+    quota = read_cgroup_file("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = read_cgroup_file("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and int(quota) > 0 and int(period) > 0:
+        return int(quota) / float(period)
+    return None
+
+
+def cgroup_memory_limit():
+    """Get the memory limit (in bytes) of the cgroup we run in (v2 or v1), returns None if there is no limit"""
+    memory_max = read_cgroup_file("/sys/fs/cgroup/memory.max")
+    if memory_max is None:
+        memory_max = read_cgroup_file("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    if not memory_max or memory_max == "max":
+        return None
+    # cgroup v1 reports no limit as a huge number (the largest multiple of the page size)
+    if int(memory_max) >= 1 << 62:
+        return None
+    return int(memory_max)
+
+
+def resource_budget(shared_decode=False, **settings):
+    """
+    Split the CPUs (and memory) we may use between the preview encoder and the slide detection, which run at the
+    same time. Without this, both size their thread pools on all cores of the host rather than on the quota of the
+    container and get throttled.
+
+    :param shared_decode: whether the detection reads the frames of the encoder (in a single process)
+    :param cpus: number of CPUs to use (0 for the CPU quota of the container, capped by the CPU affinity)
+    :param encoding_share: part of the CPUs that goes to the encoder
+    :param detection_worker_memory: memory (in MiB) a detection worker needs
+    :return dict with encoding_threads, detection_workers and opencv_threads (per detection worker)
+    """
+    options = dict(default_settings_resources)
+    options.update(settings)
+
+    cpus = options.get("cpus")
+    if not cpus:
+        try:
+            cpus = len(os.sched_getaffinity(0))
+        except AttributeError:
+            cpus = multiprocessing.cpu_count()
+        # A fractional quota gets rounded down (like the PDF extractor does), we would get throttled otherwise
+        quota = cgroup_cpu_limit()
+        if quota:
+            cpus = min(cpus, quota)
+    cpus = max(1, int(cpus))
+
+    encoding_threads = min(
+        cpus, max(1, int(round(cpus * options.get("encoding_share"))))
+    )
+    detection_cpus = max(1, cpus - encoding_threads)
+
+    if shared_decode:
+        detection_workers = 1
+    else:
+        detection_workers = detection_cpus
+        # Leave half of the memory for the encoder and the main process
+        memory_limit = cgroup_memory_limit()
+        if memory_limit:
+            detection_workers = min(
+                detection_workers,
+                max(
+                    1,
+                    memory_limit
+                    // (2 * options.get("detection_worker_memory") * 1024 * 1024),
+                ),
+            )
+
+    return {
+        "cpus": cpus,
+        "encoding_threads": encoding_threads,
+        "detection_workers": detection_workers,
+        "opencv_threads": max(1, detection_cpus // detection_workers),
+    }
+
+
+def probe_video(filename):
+    """Get the format and the streams of a video from ffprobe, returns None if ffprobe fails"""
+    try:
+        output = subprocess.check_output(
+            [
+                "ffprobe",
+                "-loglevel",
+                "error",
+                "-show_format",
+                "-show_streams",
+                "-of",
+                "json",
+                os.path.abspath(filename),
+            ]
+        )
+        return json.loads(output)
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return None
+
+
+def moov_atom_first(filename):
+    """Check whether the moov atom comes before the mdat atom in an mp4 file (so it can play while downloading)"""
+    with open(filename, "rb") as mp4_file:
+        while True:
+            header = mp4_file.read(8)
+            if len(header) < 8:
+                return False
+            size, atom = struct.unpack(">I4s", header)
+            if atom == b"moov":
+                return True
+            if atom == b"mdat":
+                return False
+            if size == 1:
+                # 64 bit size after the header
+                size = struct.unpack(">Q", mp4_file.read(8))[0] - 8
+            elif size == 0:
+                # the last atom
+                return False
+            mp4_file.seek(size - 8, os.SEEK_CUR)
+
+
+def select_preview_method(
+    filename, webm, **settings
+):  # pylint: disable=too-many-return-statements
+    """
+    Choose how to create the mp4 preview of a video, based on what ffprobe finds:
+        - copy: the video is a web friendly mp4 already (with the moov atom up front), use it as is
+        - remux: the video and audio are web friendly, copy them into a new mp4
+        - audio: the video is web friendly, copy it and transcode only the audio
+        - encode: encode the video (and audio)
+
+    :param filename: path to the video
+    :param webm: whether a webm preview is needed too (which always gets encoded)
+    :param remux_max_bitrate: maximum bitrate of the video to not encode it
+    :param remux_max_width: maximum width of the video to not encode it
+    :param remux_max_height: maximum height of the video to not encode it
+    :return tuple with the method and the reason for it
+    """
+    options = dict(default_settings_previews)
+    options.update(settings)
+
+    if webm:
+        return "encode", "a webm preview gets encoded anyway"
+    if not options.get("remux_max_bitrate"):
+        return "encode", "remuxing is disabled"
+
+    probe = probe_video(filename)
+    if probe is None:
+        return "encode", "ffprobe failed"
+    streams = probe.get("streams", [])
+    video_streams = [
+        stream for stream in streams if stream.get("codec_type") == "video"
+    ]
+    audio_streams = [
+        stream for stream in streams if stream.get("codec_type") == "audio"
+    ]
+    if not video_streams:
+        return "encode", "no video stream"
+
+    video = video_streams[0]
+    if (
+        video.get("codec_name") != "h264"
+        or video.get("profile") not in WEB_H264_PROFILES
+        or video.get("pix_fmt") != "yuv420p"
+    ):
+        return "encode", "video is %s (%s, %s)" % (
+            video.get("codec_name"),
+            video.get("profile"),
+            video.get("pix_fmt"),
+        )
+    if int(video.get("width", 0)) > options.get("remux_max_width") or int(
+        video.get("height", 0)
+    ) > options.get("remux_max_height"):
+        return "encode", "resolution is %sx%s" % (
+            video.get("width"),
+            video.get("height"),
+        )
+    # Not all containers have the bitrate of the stream, then the overall bitrate will do
+    bitrate = int(video.get("bit_rate") or probe.get("format", {}).get("bit_rate") or 0)
+    if not bitrate or bitrate > options.get("remux_max_bitrate"):
+        return "encode", "video bitrate is %d" % bitrate
+
+    if audio_streams and (
+        audio_streams[0].get("codec_name") != "aac"
+        or int(audio_streams[0].get("channels", 0)) > 2
+    ):
+        return "audio", "audio is %s (%s channels)" % (
+            audio_streams[0].get("codec_name"),
+            audio_streams[0].get("channels"),
+        )
+
+    if (
+        "mp4" in probe.get("format", {}).get("format_name", "").split(",")
+        and len(streams) == len(video_streams[:1] + audio_streams[:1])
+        and moov_atom_first(filename)
+    ):
+        return "copy", "web friendly mp4 with the moov atom up front"
+    return "remux", "web friendly H.264 video and audio"
+
 
 # Add function to do compression that is pickle-able
-def create_video_previews(filename, output_dir, mp4_filename, webm_filename, webm):
-    """Create mp4 and webm heavily compressed previews of the presentation to use in the previewer"""
+def create_video_previews(
+    filename,
+    output_dir,
+    mp4_filename,
+    webm_filename,
+    webm,
+    raw_frames=None,
+    method="encode",
+    checkpoint_dir=None,
+    **settings
+):  # pylint: disable=too-many-arguments,too-many-locals,too-many-branches,too-many-statements
+    """
+    Create mp4 and webm heavily compressed previews of the presentation to use in the previewer
+
+    :param raw_frames: optional tuple with a file descriptor, a frame rate (None for all frames) and the (width,
+    height) of the frames. The (first) encoder pass then also writes the frames it decodes as raw BGR frames to the
+    file descriptor, and closes it.
+    :param method: how to create the mp4 preview, see select_preview_method (only encode can create a webm)
+    :param checkpoint_dir: optional directory to keep the previews in as soon as they are done (as preview.mp4 and
+    preview.webm, with the method in previews.json), in case the extractor has to start over
+    :param encoding_mode: single_pass (capped CRF, all outputs from one decode) or two_pass (average bitrate)
+    :param mp4_crf: the constant rate factor of the mp4 in single pass mode
+    :param encoding_threads: number of threads of the encoders (0 for half of the cores)
+    """
+    options = dict(default_settings_previews)
+    options.update(settings)
 
     # Let's not be greedy, use half available cores since we are probably in a docker container
     # This could be done less crudely, we could leave this control to the container
-    encoding_threads = multiprocessing.cpu_count()
-    if encoding_threads > 1:
-        encoding_threads = int(np.ceil(encoding_threads / 2))
-
-    ffmpeg_stub = (
-        'ffmpeg -loglevel error -y -i "'
-        + os.path.abspath(filename)
-        + '" -threads '
-        + str(encoding_threads)
-    )
+    encoding_threads = options.get("encoding_threads")
+    if not encoding_threads:
+        encoding_threads = multiprocessing.cpu_count()
+        if encoding_threads > 1:
+            encoding_threads = int(np.ceil(encoding_threads / 2))
+
+    ffmpeg_stub = [
+        "ffmpeg",
+        "-loglevel",
+        "error",
+        "-y",
+        "-i",
+        os.path.abspath(filename),
+    ]
+    threads = ["-threads", str(encoding_threads)]
     # We use the same audio settings for both videos
-    no_audio = " -an "
-    mp4_audio = " -strict -2 -acodec aac -ac 1 -b:a 64k "
-    webm_audio = " -acodec libopus -ac 1 -b:a 64k "
+    no_audio = ["-an"]
+    mp4_audio = ["-strict", "-2", "-acodec", "aac", "-ac", "1", "-b:a", "64k"]
+    webm_audio = ["-acodec", "libopus", "-ac", "1", "-b:a", "64k"]
     # Use very heavy compression since most of what we deal with is 2d without shadows
-    mp4_settings = " -vcodec libx264 -preset medium -b:v 96k -qmax 42 -maxrate 250k "
-    webm_settings = " -vcodec libvpx -quality good -b:v 96k -crf 10 -qmin 0 -qmax 42 -maxrate 250k -bufsize 1000k "
-
-    # The 2 pass method requires some temporary files so let's (temporarily) change to the output dir we have
-    current_dir = os.getcwd()
-    os.chdir(output_dir)
-
-    # First let's do mp4
-    ffmpeg_command = ffmpeg_stub + mp4_settings + no_audio + "-pass 1 -f mp4 /dev/null"
-    # using the shell is a potential security hazard but our filenames are sanitized by Clowder
-    subprocess.check_output(ffmpeg_command, stderr=subprocess.STDOUT, shell=True)
-    ffmpeg_command = (
-        ffmpeg_stub
-        + mp4_settings
-        + mp4_audio
-        + "-pass 2 -f mp4 "
-        + '"%s"' % mp4_filename
+    mp4_settings = [
+        "-vcodec",
+        "libx264",
+        "-preset",
+        "medium",
+        "-qmax",
+        "42",
+        "-maxrate",
+        "250k",
+    ]
+    webm_settings = [
+        "-vcodec",
+        "libvpx",
+        "-quality",
+        "good",
+        "-b:v",
+        "96k",
+        "-crf",
+        "10",
+        "-qmin",
+        "0",
+        "-qmax",
+        "42",
+        "-maxrate",
+        "250k",
+        "-bufsize",
+        "1000k",
+    ]
+    mp4_output = ["-f", "mp4", os.path.join(output_dir, mp4_filename)]
+    webm_output = ["-f", "webm", os.path.join(output_dir, webm_filename)]
+
+    # Optional extra output with the decoded frames for the slide detection
+    raw_frames_output = []
+    if raw_frames is not None:
+        raw_frames_fd = raw_frames[0]
+        raw_frames_output = raw_frames_arguments(raw_frames)
+
+    if method == "copy":
+        shutil.copyfile(filename, os.path.join(output_dir, mp4_filename))
+        # We only need ffmpeg for the frames
+        ffmpeg_commands = []
+        if raw_frames is not None:
+            ffmpeg_commands.append(ffmpeg_stub + raw_frames_output)
+    elif method in ["remux", "audio"]:
+        # Copy the video stream (and the audio unless it needs to be transcoded), with the moov atom up front
+        ffmpeg_command = ffmpeg_stub + [
+            "-map",
+            "0:v:0",
+            "-map",
+            "0:a:0?",
+            "-c:v",
+            "copy",
+        ]
+        if method == "remux":
+            ffmpeg_command += ["-c:a", "copy"]
+        else:
+            ffmpeg_command += mp4_audio
+        ffmpeg_command += ["-movflags", "+faststart"] + mp4_output
+        ffmpeg_commands = [ffmpeg_command + raw_frames_output]
+    elif options.get("encoding_mode") == "two_pass":
+        # The 2 pass method requires some temporary files, keep them in the output dir we have
+        mp4_settings += [
+            "-b:v",
+            "96k",
+            "-passlogfile",
+            os.path.join(output_dir, "mp4pass"),
+        ]
+        webm_settings += ["-passlogfile", os.path.join(output_dir, "webmpass")]
+        ffmpeg_commands = [
+            ffmpeg_stub
+            + threads
+            + mp4_settings
+            + no_audio
+            + ["-pass", "1", "-f", "mp4", os.devnull]
+            + raw_frames_output,
+            ffmpeg_stub
+            + threads
+            + mp4_settings
+            + mp4_audio
+            + ["-pass", "2"]
+            + mp4_output,
+        ]
+        if webm:
+            ffmpeg_commands += [
+                ffmpeg_stub
+                + threads
+                + webm_settings
+                + no_audio
+                + ["-pass", "1", "-f", "webm", os.devnull],
+                ffmpeg_stub
+                + threads
+                + webm_settings
+                + webm_audio
+                + ["-pass", "2"]
+                + webm_output,
+            ]
+    else:
+        # The CRF keeps the quality constant, the maximum rate keeps the size down. A single pass with all outputs
+        # only decodes the video once.
+        mp4_settings += ["-crf", str(options.get("mp4_crf")), "-bufsize", "1000k"]
+        ffmpeg_command = ffmpeg_stub + threads + mp4_settings + mp4_audio + mp4_output
+        if webm:
+            ffmpeg_command += threads + webm_settings + webm_audio + webm_output
+        ffmpeg_commands = [ffmpeg_command + raw_frames_output]
+
+    try:
+        for index, ffmpeg_command in enumerate(ffmpeg_commands):
+            # The frames for the slide detection come from the first command
+            if index == 0 and raw_frames is not None:
+                subprocess.check_call(ffmpeg_command, stdout=raw_frames_fd)
+                os.close(raw_frames_fd)
+                raw_frames = None
+            else:
+                subprocess.check_output(ffmpeg_command, stderr=subprocess.STDOUT)
+    finally:
+        if raw_frames is not None:
+            os.close(raw_frames_fd)
+
+    # Keep the previews in case we have to start over
+    if checkpoint_dir is not None:
+        shutil.copyfile(
+            os.path.join(output_dir, mp4_filename),
+            os.path.join(checkpoint_dir, "preview.mp4"),
+        )
+        if webm:
+            shutil.copyfile(
+                os.path.join(output_dir, webm_filename),
+                os.path.join(checkpoint_dir, "preview.webm"),
+            )
+        write_checkpoint(
+            os.path.join(checkpoint_dir, "previews.json"), {"method": method}
+        )
+
+
+def raw_frames_arguments(raw_frames):
+    """
+    Get the ffmpeg arguments of the output with the decoded frames for the slide detection
+
+    :param raw_frames: tuple with a file descriptor, a frame rate (None for all frames) and the (width, height) of the
+    frames, see create_video_previews
+    """
+    _, raw_frames_fps, raw_frames_size = raw_frames
+    video_filter = "scale=%d:%d" % raw_frames_size
+    if raw_frames_fps:
+        video_filter = "fps=%s,%s" % (raw_frames_fps, video_filter)
+    return [
+        "-map",
+        "0:v:0",
+        "-vf",
+        video_filter,
+        "-pix_fmt",
+        "bgr24",
+        "-f",
+        "rawvideo",
+        "pipe:1",
+    ]
+
+
+def decode_video_frames(filename, raw_frames):
+    """
+    Only decode the video to the frames for the slide detection, the same frames create_video_previews writes. For the
+    detection of a file whose previews were done before, so it sees (and resumes from) the same frames.
+
+    :param raw_frames: tuple with a file descriptor, a frame rate (None for all frames) and the (width, height) of the
+    frames, see create_video_previews. The file descriptor gets closed.
+    """
+    try:
+        subprocess.check_call(
+            ["ffmpeg", "-loglevel", "error", "-y", "-i", os.path.abspath(filename)]
+            + raw_frames_arguments(raw_frames),
+            stdout=raw_frames[0],
+        )
+    finally:
+        os.close(raw_frames[0])
+
+
+class RawVideoReader:
+    """
+    Read raw BGR frames (as written by ffmpeg with -f rawvideo -pix_fmt bgr24) from a pipe. Has the parts of the
+    cv2.VideoCapture interface that the slide detection uses.
+    """
+
+    def __init__(self, pipe, width, height, fps):
+        """
+        :param pipe: file object to read the frames from
+        :param width: width of the frames
+        :param height: height of the frames
+        :param fps: frame rate of the frames
+        """
+        self.pipe = pipe
+        self.fps = fps
+        self.frames_read = 0
+        self.frame = np.empty((height, width, 3), dtype=np.uint8)
+
+    def isOpened(self):  # pylint: disable=invalid-name
+        """The pipe is open until we release it"""
+        return not self.pipe.closed
+
+    def _read_into(self, image):
+        """Read the next frame into image, returns False at the end of the pipe"""
+        buffer = memoryview(image).cast("B")
+        position = 0
+        while position < len(buffer):
+            count = self.pipe.readinto(buffer[position:])
+            if not count:
+                return False
+            position += count
+        self.frames_read += 1
+        return True
+
+    def grab(self):
+        """Read the next frame (into our own buffer)"""
+        return self._read_into(self.frame)
+
+    def retrieve(self, image=None):
+        """Return the last grabbed frame"""
+        if image is None or image.shape != self.frame.shape:
+            return True, self.frame.copy()
+        np.copyto(image, self.frame)
+        return True, image
+
+    def read(self, image=None):
+        """Read the next frame, into image if it is given"""
+        if image is None or image.shape != self.frame.shape:
+            if not self.grab():
+                return False, None
+            return self.retrieve()
+        return self._read_into(image), image
+
+    def set(self, prop, value):
+        """Only seeking forward (by skipping frames) is possible"""
+        if prop != cv2.CAP_PROP_POS_FRAMES or value < self.frames_read:
+            return False
+        while self.frames_read < value:
+            if not self.grab():
+                return False
+        return True
+
+    def get(self, prop):
+        """Only the timestamp (of the last frame read) is known"""
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            return max(0, self.frames_read - 1) * 1000.0 / self.fps
+        return 0
+
+    def release(self):
+        """Close the pipe"""
+        self.pipe.close()
+
+
+def drain_pipe(pipe):
+    """Read (and drop) everything that is left in a pipe, then close it"""
+    with pipe:
+        while pipe.read(1 << 20):
+            pass
+
+
+def read_checkpoint(checkpoint, start_frame, end_frame, fps):
+    """
+    Read the checkpoint of the detection of a segment, returns None if there is none (or it is for another segment, or
+    its screenshots are gone)
+    """
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return None
+    try:
+        with open(checkpoint, "r") as checkpoint_file:
+            state = json.load(checkpoint_file)
+    except (IOError, OSError, ValueError):
+        return None
+    if (
+        state.get("start_frame") != start_frame
+        or state.get("end_frame") != end_frame
+        or state.get("fps") != fps
+    ):
+        return None
+    if not all(os.path.exists(slide[2]) for slide in state["slides"]):
+        return None
+    return state
+
+
+def replay_start(resume_frame, replay_frames, triggers, ignore_frames):
+    """
+    Get the frame to warm up the background model from when resuming the detection at resume_frame, so that the warm
+    up goes over replay_frames frames the detection analysed (the frames it ignored after a trigger don't count)
+
+    :param triggers: frame numbers of the triggers the detection found before resume_frame
+    """
+    start = resume_frame
+    for trigger in sorted(triggers, reverse=True):
+        analysed = start - (trigger + ignore_frames + 1)
+        if analysed >= replay_frames:
+            break
+        replay_frames -= max(0, analysed)
+        start = trigger + 1
+    return start - replay_frames
+
+
+def write_checkpoint(checkpoint, state):
+    """Write the checkpoint of the detection of a segment (atomically, a crash never leaves half a checkpoint)"""
+    with open(checkpoint + ".tmp", "w") as checkpoint_file:
+        json.dump(state, checkpoint_file)
+    os.replace(checkpoint + ".tmp", checkpoint)
+
+
+# Add function to find slide transitions in (a part of) a video that is pickle-able
+def detect_slide_transitions(
+    video, output_dir, start_frame, end_frame, detection, progress=None, checkpoint=None
+):  # pylint: disable=too-many-locals,too-many-arguments,too-many-branches,too-many-statements
+    """
+    Find the slide transitions between start_frame and end_frame of a video with the advanced algorithm, see
+    VideoMetaData.slide_find_advanced. Before start_frame the detection warms up: it first trains the background
+    model over its history, so that the frames of a fresh model (which sees everything as foreground) never get
+    averaged, then fills the average over motion_capture_averaging_time, like the detection of the whole video has
+    them at that frame.
+
+    :param video: path to the video, or an opened cv2.VideoCapture (or RawVideoReader) to read the frames from
+    :param output_dir: directory to write the screenshots of the slides to
+    :param start_frame: first frame that can be a transition
+    :param end_frame: the frame after the last one that can be a transition
+    :param detection: dict with the parameters of the detection as worked out by slide_find_advanced
+    :param progress: optional function that gets called with the number of processed frames
+    :param checkpoint: optional path to save the progress of the detection to every checkpoint_interval seconds. If it
+    exists, the detection resumes from it with the average it had (warming up the background model again before the
+    frame it stopped at).
+    :return tuple with the list of tuples of frame number, timestamp and path to screenshot of the transitions, the
+    frame number and the timestamp where the detection stopped
+    """
+    logger = logging.getLogger(__name__)
+
+    width = detection["width"]
+    height = detection["height"]
+    fps = detection["fps"]
+    num_frames = detection["num_frames"]
+    analysis_fps = detection["analysis_fps"]
+    analysis_size = detection["analysis_size"]
+    analysis_mask = detection["analysis_mask"]
+    trigger_ratio = detection["trigger_ratio"]
+    min_pixel_change_av = detection["min_pixel_change_av"]
+    minimum_slide_length_in_frames = detection["minimum_slide_length_in_frames"]
+    averaging_frames = detection["averaging_frames"]
+    ignore_frames = detection["ignore_frames"]
+    msec_to_delay_screenshot = detection["msec_to_delay_screenshot"]
+    grayscale = detection["grayscale"]
+
+    # Stick to our part of the CPU budget, also in the worker processes
+    if detection["opencv_threads"]:
+        cv2.setNumThreads(detection["opencv_threads"])
+
+    # Resume from where a previous attempt stopped, with its average. The warm up rebuilds the background model.
+    checkpoint_interval = detection.get("checkpoint_interval")
+    state = read_checkpoint(checkpoint, start_frame, end_frame, fps)
+    if state is not None and state["done"]:
+        logger.info(
+            "Found the slides between frame %d and %d before", start_frame, end_frame
+        )
+        return (
+            [tuple(slide) for slide in state["slides"]],
+            state["frame_index"],
+            state["final_timestamp"],
+        )
+
+    # We only release the video if we opened it
+    if isinstance(video, str):
+        cap = cv2.VideoCapture(video)
+        if not cap.isOpened():
+            raise IOError("Failed to open file %s" % video)
+    else:
+        cap = video
+
+    slides = []
+    resume_frame = start_frame
+    average_warmup_frames = detection["average_warmup_frames"]
+    frame_index = max(
+        0, start_frame - detection["model_warmup_frames"] - average_warmup_frames
     )
-    subprocess.check_output(ffmpeg_command, stderr=subprocess.STDOUT, shell=True)
-    # Now do webm
-    if webm:
-        ffmpeg_command = (
-            ffmpeg_stub + webm_settings + no_audio + "-pass 1 -f webm /dev/null"
+    # Only the first segment starts with a slide, the others can have a transition right away. Their warm up is not
+    # in the frames ignored after a trigger either.
+    if start_frame == 0:
+        previous_trigger_frame = 0
+    else:
+        previous_trigger_frame = frame_index - minimum_slide_length_in_frames - 1
+    replayed_triggers = set()
+
+    #  Allocate space for our average of the changes of the analysed frames in the last averaging_time seconds
+    av_array = np.zeros(averaging_frames, dtype=int)
+    average = 0.0
+    analysed_frames = 0
+
+    if state is not None:
+        logger.info("Resuming the slide detection at frame %d", state["frame_index"])
+        slides = [tuple(slide) for slide in state["slides"]]
+        resume_frame = state["frame_index"]
+        av_array[:] = state["av_array"]
+        average = state["average"]
+        analysed_frames = state["analysed_frames"]
+        # The average is as it was, only the background model needs a warm up. It goes over the frames the detection
+        # analysed before (but not from before the warm up of the segment), and over its triggers again, so it ends
+        # with the trigger the detection had at resume_frame.
+        average_warmup_frames = 0
+        replayed_triggers = set(slide[0] for slide in slides)
+        frame_index = max(
+            frame_index,
+            replay_start(
+                resume_frame,
+                detection["model_warmup_frames"],
+                replayed_triggers,
+                ignore_frames,
+            ),
         )
-        subprocess.check_output(ffmpeg_command, stderr=subprocess.STDOUT, shell=True)
-        ffmpeg_command = (
-            ffmpeg_stub
-            + webm_settings
-            + webm_audio
-            + "-pass 2 -f webm "
-            + '"%s"' % webm_filename
+        previous_trigger_frame = max(
+            [previous_trigger_frame]
+            + [trigger for trigger in replayed_triggers if trigger < frame_index]
+        )
+
+    # Only seek once, to the start of the warm up. Only its last motion_capture_averaging_time gets averaged.
+    average_start = resume_frame - average_warmup_frames
+    if frame_index > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+
+    # Set up the motion capture algorithm to learn over our set averaging time and output B/W images
+    fgbg = cv2.createBackgroundSubtractorKNN(
+        history=detection["knn_history"],
+        dist2Threshold=detection["knn_dist2_threshold"],
+        detectShadows=False,
+    )
+
+    # Allocate the frame buffers once, all frames are decoded, converted and compared in place. The frame itself is
+    # kept as it is for the screenshots.
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    if grayscale:
+        gray_frame = np.empty((height, width), dtype=np.uint8)
+        if analysis_size != (width, height):
+            analysis_frame = np.empty(
+                (analysis_size[1], analysis_size[0]), dtype=np.uint8
+            )
+        else:
+            analysis_frame = gray_frame
+    else:
+        analysis_frame = np.empty_like(frame)
+    fgmask = np.empty(analysis_frame.shape[:2], dtype=np.uint8)
+
+    # The screenshots are taken msec_to_delay_screenshot after the transition, in the same pass over the video,
+    # and get written out in the background
+    pending_screenshots = collections.deque()
+    screenshot_writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    screenshots_written = []
+    last_checkpoint = time.time()
+
+    progress_step = max(1, int(round(num_frames / 100.0)))
+    # Keep going after the end of the segment until we have all the screenshots
+    while frame_index < end_frame or (pending_screenshots and frame_index < num_frames):
+        # Only analyse frames at the analysis rate, and only outside the region where a slide will never be
+        # extracted (due to min_slide_length). The other frames we just skip over.
+        analyse = frame_index < end_frame and (
+            frame_index == 0
+            or (
+                int(frame_index * analysis_fps / fps)
+                != int((frame_index - 1) * analysis_fps / fps)
+                and frame_index > (previous_trigger_frame + ignore_frames)
+            )
+        )
+        if analyse:
+            ret, frame = cap.read(frame)
+        else:
+            ret = cap.grab()
+
+        if not ret:
+            break
+
+        if analyse:
+            if grayscale:
+                cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray_frame)
+                if analysis_frame is not gray_frame:
+                    cv2.resize(
+                        gray_frame,
+                        analysis_size,
+                        dst=analysis_frame,
+                        interpolation=cv2.INTER_AREA,
+                    )
+            else:
+                np.copyto(analysis_frame, frame)
+
+            # Apply our mask
+            if analysis_mask is not None:
+                cv2.bitwise_and(analysis_frame, analysis_mask, dst=analysis_frame)
+
+            # Apply the background subtraction and count the white pixels
+            fgbg.apply(analysis_frame, fgmask)
+            # If you want to see what the algorithm is looking at, uncomment the below
+            # cv2.imshow('frame', fgmask)
+            # if cv2.waitKey(1) & 0xFF == ord('q'):
+            # break
+
+            # Count the changed pixels (based on the learned background)
+            whites = int(cv2.countNonZero(fgmask))
+
+            # Check if we have a trigger (frames of the warm up never are, but they go over the triggers found before)
+            if frame_index in replayed_triggers:
+                previous_trigger_frame = frame_index
+            if frame_index >= resume_frame and (
+                (frame_index - previous_trigger_frame) > minimum_slide_length_in_frames
+                or frame_index == 0
+            ):
+                if average > min_pixel_change_av:
+                    proxy_average = average
+                else:
+                    proxy_average = min_pixel_change_av
+
+                if (whites > trigger_ratio * proxy_average) or frame_index == 0:
+                    # Grab the slide
+                    timestamp = cap.get(cv2.CAP_PROP_POS_MSEC)
+                    logger.debug("Found slide transition at %s", timestamp)
+
+                    # Set the path now, but write the image later
+                    slide_path = os.path.join(
+                        output_dir, "transition%08d.webp" % frame_index
+                    )
+
+                    slides.append((frame_index, timestamp, slide_path))
+                    pending_screenshots.append(
+                        (timestamp + msec_to_delay_screenshot, slide_path)
+                    )
+
+                    previous_trigger_frame = frame_index
+                    # Restart the averaging process
+                    average = 0.0
+                    av_array[:] = 0
+
+            # Update our average and the associated array. Since we know that the average is restarted after every
+            # trigger things are sequential and it is safe to use modulo here. The frames of the warm up of the
+            # background model are left out.
+            if frame_index >= average_start and previous_trigger_frame != frame_index:
+                # First remove the value of the previous entry from the average
+                average -= av_array[analysed_frames % averaging_frames] / float(
+                    averaging_frames
+                )
+                # Add the new value to the array
+                av_array[analysed_frames % averaging_frames] = whites
+                # Update the average
+                average += av_array[analysed_frames % averaging_frames] / float(
+                    averaging_frames
+                )
+                analysed_frames += 1
+
+        # Take the screenshots that are due at this frame
+        if (
+            pending_screenshots
+            and cap.get(cv2.CAP_PROP_POS_MSEC) >= pending_screenshots[0][0]
+        ):
+            if not analyse:
+                ret, frame = cap.retrieve(frame)
+            if ret:
+                screenshot = frame.copy()
+            else:
+                screenshot = np.ones((height, width, 3), np.uint8) * 255
+            while (
+                pending_screenshots
+                and cap.get(cv2.CAP_PROP_POS_MSEC) >= pending_screenshots[0][0]
+            ):
+                _, slide_path = pending_screenshots.popleft()
+                screenshots_written.append(
+                    (
+                        slide_path,
+                        screenshot_writer.submit(
+                            cv2.imwrite,
+                            slide_path,
+                            screenshot,
+                            [cv2.IMWRITE_WEBP_QUALITY, 80],
+                        ),
+                    )
+                )
+
+        frame_index += 1
+        if progress is not None and frame_index % progress_step == 0:
+            progress(frame_index)
+
+        # Save our progress once all screenshots so far are written
+        if (
+            checkpoint is not None
+            and checkpoint_interval
+            and not pending_screenshots
+            and frame_index < end_frame
+            and time.time() - last_checkpoint >= checkpoint_interval
+        ):
+            for _, future in screenshots_written:
+                future.result()
+            write_checkpoint(
+                checkpoint,
+                {
+                    "start_frame": start_frame,
+                    "end_frame": end_frame,
+                    "fps": fps,
+                    "done": False,
+                    "frame_index": frame_index,
+                    "av_array": av_array.tolist(),
+                    "average": average,
+                    "analysed_frames": analysed_frames,
+                    "slides": slides,
+                },
+            )
+            last_checkpoint = time.time()
+
+    final_timestamp = cap.get(cv2.CAP_PROP_POS_MSEC)
+    # Screenshots that would be after the end of the video, just use an empty white image
+    for _, slide_path in pending_screenshots:
+        screenshots_written.append(
+            (
+                slide_path,
+                screenshot_writer.submit(
+                    cv2.imwrite,
+                    slide_path,
+                    np.ones((height, width, 3), np.uint8) * 255,
+                    [cv2.IMWRITE_WEBP_QUALITY, 80],
+                ),
+            )
         )
-        subprocess.check_output(ffmpeg_command, stderr=subprocess.STDOUT, shell=True)
+    screenshot_writer.shutdown(wait=True)
+    for slide_path, future in screenshots_written:
+        if not future.result():
+            logger.error("Failed to write screenshot %s", slide_path)
+    if isinstance(video, str):
+        cap.release()
 
-    # Change back to the original directory
-    os.chdir(current_dir)
+    if checkpoint is not None:
+        write_checkpoint(
+            checkpoint,
+            {
+                "start_frame": start_frame,
+                "end_frame": end_frame,
+                "fps": fps,
+                "done": True,
+                "frame_index": frame_index,
+                "final_timestamp": final_timestamp,
+                "slides": slides,
+            },
+        )
 
-    return
+    return slides, frame_index, final_timestamp
 
 
 class VideoMetaData(Extractor):
@@ -171,10 +1136,21 @@ class VideoMetaData(Extractor):
 
         self.results = []
         self.tempdir = None
+        self.checkpoint_lock = None
         self.mask_settings = None
         self.algorithm_settings = None
+        self.preview_settings = None
+        self.resource_settings = None
         self.read_settings()
 
+        if self.resource_settings is not None and not self.resource_settings.get(
+            "checkpoint_dir"
+        ):
+            self.logger.warning(
+                "No checkpoint_dir set, the checkpoints in the temp dir don't survive a redeploy of the extractor "
+                "(set it to a directory on a persistent volume)"
+            )
+
     def read_settings(self, filename=None):
         """
         Read the default settings for the extractor from the given file.
@@ -197,16 +1173,20 @@ class VideoMetaData(Extractor):
                 self.algorithm_settings = (
                     algorithm_settings[0] if algorithm_settings else {}
                 )
+                self.preview_settings = settings.get("previews") or {}
+                self.resource_settings = settings.get("resources") or {}
         except (IOError, yaml.YAMLError) as err:
             self.logger.error(
                 "Failed to read or parse %s as settings file: %s", filename, err
             )
 
         self.logger.debug(
-            "Read settings from %s: %s + %s",
+            "Read settings from %s: %s + %s + %s + %s",
             filename,
             self.mask_settings,
             self.algorithm_settings,
+            self.preview_settings,
+            self.resource_settings,
         )
 
     def check_message(
@@ -248,11 +1228,30 @@ class VideoMetaData(Extractor):
         if isinstance(user_slides, dict):
             self.algorithm_settings.update(user_slides)
 
+        user_previews = usersettings.get("previews")
+        if isinstance(user_previews, dict):
+            self.preview_settings.update(user_previews)
+
+        user_resources = usersettings.get("resources")
+        if isinstance(user_resources, dict):
+            self.resource_settings.update(user_resources)
+
         self.tempdir = tempfile.mkdtemp(prefix="clowder-video-presentation")
 
-        self.find_slides_transitions(
-            connector, host, secret_key, resource, masks=self.mask_settings, webm=False
-        )
+        try:
+            self.find_slides_transitions(
+                connector,
+                host,
+                secret_key,
+                resource,
+                masks=self.mask_settings,
+                webm=False,
+            )
+        finally:
+            # Let a next attempt at the file have the checkpoints
+            if self.checkpoint_lock is not None:
+                self.checkpoint_lock.close()
+                self.checkpoint_lock = None
 
         shutil.rmtree(self.tempdir, ignore_errors=True)
 
@@ -405,30 +1404,94 @@ class VideoMetaData(Extractor):
 
         return preview_id
 
+    def remove_previews(self, connector, host, secret_key, uploads):
+        """
+        Remove the previews of (finished or still running) uploads from Clowder again (pyclowder has no call for
+        it). Failing to do so is logged, but not fatal: it only leaves previews behind.
+
+        :param uploads: list of futures of try_upload_preview_file() calls
+        """
+        for upload in uploads:
+            try:
+                preview_id = upload.result()
+            except Exception:  # pylint: disable=broad-except
+                # Never made it, nothing to remove
+                continue
+            url = "%s/api/previews/%s" % (host.rstrip("/"), preview_id)
+            try:
+                response = connector.delete(
+                    url,
+                    raise_status=False,
+                    params={"key": secret_key},
+                    verify=connector.ssl_verify if connector else True,
+                )
+            except IOError as err:
+                self.logger.warning("Failed to remove preview %s: %s", preview_id, err)
+                continue
+            if not response.ok:
+                self.logger.warning(
+                    "Failed to remove preview %s (HTTP status %d)",
+                    preview_id,
+                    response.status_code,
+                )
+
+    def prepare_checkpoint_dir(self, resource, settings):
+        """
+        Get (and create) the directory with the checkpoints of a file processed with the given settings, returns None
+        when checkpoints are disabled. Checkpoints of files that never got redelivered get removed.
+
+        The directory is locked (in self.checkpoint_lock) until the file is done. Should another attempt at the same
+        file still be running, we don't resume from (or write to) its checkpoints, but use a directory of our own.
+        """
+        options = dict(default_settings_resources)
+        options.update(self.resource_settings)
+        if not options.get("checkpoint_interval"):
+            return None
+
+        checkpoints_root = options.get("checkpoint_dir") or os.path.join(
+            tempfile.gettempdir(), "clowder-video-presentation-checkpoints"
+        )
+        if os.path.isdir(checkpoints_root):
+            expired = time.time() - 3600 * options.get("checkpoint_max_age")
+            for name in os.listdir(checkpoints_root):
+                path = os.path.join(checkpoints_root, name)
+                if os.path.getmtime(path) < expired:
+                    lock = lock_checkpoint_dir(path)
+                    if lock is None:
+                        # Still in use
+                        continue
+                    self.logger.debug("Removing expired checkpoints %s", path)
+                    shutil.rmtree(path, ignore_errors=True)
+                    lock.close()
+
+        settings_hash = hashlib.sha1(
+            json.dumps(settings, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()[:16]
+        checkpoint_dir = os.path.join(
+            checkpoints_root, "%s-%s" % (resource["id"], settings_hash)
+        )
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.checkpoint_lock = lock_checkpoint_dir(checkpoint_dir)
+        if self.checkpoint_lock is None:
+            self.logger.warning(
+                "Checkpoints in %s are in use by another attempt at the file, starting over without them",
+                checkpoint_dir,
+            )
+            checkpoint_dir = os.path.join(self.tempdir, "checkpoints")
+            os.makedirs(checkpoint_dir, exist_ok=True)
+        return checkpoint_dir
+
     def find_slides_transitions(
         self, connector, host, secret_key, resource, masks=None, webm=False
-    ):  # pylint: disable=unused-argument,too-many-arguments
+    ):  # pylint: disable=unused-argument,too-many-arguments,too-many-locals,too-many-branches,too-many-statements
         """Find slides"""
 
-        # First let's set the encoders off in the background to create our previews (uses only half available
-        # processors so should be safe to leave in the background)
         self.logger.debug(resource)
         file_name = os.path.splitext(sanitize_filename(resource["name"]))[0]
         # Only use alphanumerics
         file_name = filter(str.isalnum, file_name)
         mp4_preview = "%s.mp4" % file_name
         webm_preview = "%s.webm" % file_name
-        encode_job = multiprocessing.Process(
-            target=create_video_previews,
-            args=(
-                resource["local_paths"][0],
-                self.tempdir,
-                mp4_preview,
-                webm_preview,
-                webm,
-            ),
-        )
-        encode_job.start()
 
         if self.algorithm_settings.get("algorithm", "") == "basic":
             settings = dict(default_settings_basic)  # make sure it's a copy
@@ -444,9 +1507,6 @@ class VideoMetaData(Extractor):
             self.logger.debug(
                 "Using basic algorithm for finding slides. settings: %s", settings
             )
-            results = self.slide_find_basic(
-                resource["local_paths"][0], masks=masks, **settings
-            )
         else:
             settings = dict(default_settings_advanced)  # make sure it's a copy
             settings.update(
@@ -461,17 +1521,241 @@ class VideoMetaData(Extractor):
             self.logger.info(
                 "Using advanced algorithm for finding slides. settings: %s", settings
             )
-            results = self.slide_find_advanced(
-                resource["local_paths"][0], connector, resource, masks=masks, **settings
+
+        preview_settings = dict(default_settings_previews)  # make sure it's a copy
+        preview_settings.update(
+            dict(
+                [
+                    (key, self.preview_settings[key])
+                    for key in self.preview_settings
+                    if key in default_settings_previews.keys()
+                ]
+            )
+        )
+
+        # A redelivered file resumes from the checkpoints of the previous attempt, the previews it encoded included
+        checkpoint_dir = self.prepare_checkpoint_dir(
+            resource, [settings, preview_settings, masks, webm]
+        )
+        previews_checkpoint = None
+        if checkpoint_dir is not None:
+            previews_checkpoint = os.path.join(checkpoint_dir, "previews.json")
+        previews_done = previews_checkpoint is not None and os.path.exists(
+            previews_checkpoint
+        )
+        if previews_done:
+            self.logger.info("Using the previews encoded before")
+            with open(previews_checkpoint, "r") as checkpoint_file:
+                preview_method = json.load(checkpoint_file)["method"]
+            shutil.copyfile(
+                os.path.join(checkpoint_dir, "preview.mp4"),
+                os.path.join(self.tempdir, mp4_preview),
+            )
+            if webm:
+                shutil.copyfile(
+                    os.path.join(checkpoint_dir, "preview.webm"),
+                    os.path.join(self.tempdir, webm_preview),
+                )
+
+        # The advanced algorithm can find the slides in the frames the encoder decodes anyway, the encoder then also
+        # writes them to a pipe. When the previews were done before, a decoder writes the same frames, the checkpoints
+        # of the detection are for those.
+        raw_frames = None
+        frames_pipe = None
+        if self.algorithm_settings.get("algorithm", "") != "basic" and settings.get(
+            "shared_decode"
+        ):
+            cap = cv2.VideoCapture(resource["local_paths"][0])
+            if cap.isOpened():
+                raw_frames_fps = settings.get("analysis_fps")
+                if raw_frames_fps and raw_frames_fps > cap.get(cv2.CAP_PROP_FPS):
+                    raw_frames_fps = None
+                read_fd, write_fd = os.pipe()
+                frames_pipe = os.fdopen(read_fd, "rb")
+                raw_frames = (
+                    write_fd,
+                    raw_frames_fps,
+                    (
+                        int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                        int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                    ),
+                )
+            cap.release()
+
+        # The encoder and the detection run at the same time, share the CPUs of the container between them
+        budget = resource_budget(
+            shared_decode=raw_frames is not None,
+            **dict(
+                [
+                    (key, self.resource_settings[key])
+                    for key in self.resource_settings
+                    if key in default_settings_resources.keys()
+                ]
+            )
+        )
+        self.logger.info("Resource budget: %s", budget)
+        if not preview_settings.get("encoding_threads"):
+            preview_settings["encoding_threads"] = budget["encoding_threads"]
+        if self.algorithm_settings.get("algorithm", "") != "basic":
+            if not settings.get("detection_workers"):
+                settings["detection_workers"] = budget["detection_workers"]
+            # Only the setting that is unset gets the budget, 0 keeps the OpenCV default
+            if settings.get("opencv_threads") is None:
+                settings["opencv_threads"] = budget["opencv_threads"]
+            if settings["opencv_threads"]:
+                cv2.setNumThreads(settings["opencv_threads"])
+        else:
+            cv2.setNumThreads(budget["opencv_threads"])
+        encode_job = None
+        decode_job = None
+        if previews_done and raw_frames is not None:
+            decode_job = multiprocessing.Process(
+                target=decode_video_frames,
+                args=(resource["local_paths"][0], raw_frames),
             )
+            decode_job.start()
+            # Only the decoder writes to the pipe
+            os.close(raw_frames[0])
+        elif not previews_done:
+            self.logger.debug(
+                "Encoding the previews with settings: %s", preview_settings
+            )
+            # Videos that are web friendly already don't need to be encoded again
+            preview_method, preview_reason = select_preview_method(
+                resource["local_paths"][0], webm, **preview_settings
+            )
+            self.logger.info(
+                "Creating the mp4 preview with method %s: %s",
+                preview_method,
+                preview_reason,
+            )
+
+            # Let's set the encoders off in the background to create our previews (uses only half available
+            # processors so should be safe to leave in the background)
+            encode_job = multiprocessing.Process(
+                target=create_video_previews,
+                args=(
+                    resource["local_paths"][0],
+                    self.tempdir,
+                    mp4_preview,
+                    webm_preview,
+                    webm,
+                    raw_frames,
+                    preview_method,
+                    checkpoint_dir,
+                ),
+                kwargs=preview_settings,
+            )
+            encode_job.start()
+            if raw_frames is not None:
+                # Only the encoder writes to the pipe
+                os.close(raw_frames[0])
 
-        # Wait for encoder job to finish and upload the compressed previews
-        encode_job.join()
-        # Check the output files exist, if so upload them
-        mp4_preview_file = os.path.join(self.tempdir, mp4_preview)
-        webm_preview_file = os.path.join(self.tempdir, webm_preview)
-        if os.path.exists(mp4_preview_file):
-            mp4_preview_id = self.try_upload_preview_file(
+        try:
+            if self.algorithm_settings.get("algorithm", "") == "basic":
+                results = self.slide_find_basic(
+                    resource["local_paths"][0], masks=masks, **settings
+                )
+            else:
+                results = self.slide_find_advanced(
+                    resource["local_paths"][0],
+                    connector,
+                    resource,
+                    frames_pipe=frames_pipe,
+                    checkpoint_dir=checkpoint_dir,
+                    checkpoint_interval=self.resource_settings.get(
+                        "checkpoint_interval",
+                        default_settings_resources["checkpoint_interval"],
+                    ),
+                    masks=masks,
+                    **settings
+                )
+        finally:
+            if frames_pipe is not None:
+                # Read whatever frames the detection didn't, so the encoder doesn't get stuck writing to the pipe
+                threading.Thread(
+                    target=drain_pipe, args=(frames_pipe,), daemon=True
+                ).start()
+
+        # Upload the slides while the previews are still being encoded, only the metadata has to wait for all of them
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(
+                1,
+                int(
+                    self.resource_settings.get(
+                        "upload_threads", default_settings_resources["upload_threads"]
+                    )
+                ),
+            )
+        ) as upload_pool:
+            thumbnail_upload = None
+            slide_uploads = []
+            for idx, (frame_idx, time_idx, slidepath) in enumerate(results):
+                # last second/frame always gets added for WebVTT but hasn't got a slidepath set
+                if not slidepath:
+                    slide_uploads.append((frame_idx, time_idx, None))
+                    continue
+
+                # Create section for file (currently not used)
+                # sectionid = sections_upload(connector, host, secret_key, {'file_id': resource['id']})
+                # slidemeta = {
+                #    'section_id': sectionid,
+                # }
+                # description = "Slide %2d at %s" % (idx + 1, datetime.timedelta(milliseconds=time_idx))
+                # upload preview & associated it with the section
+                if idx == 0:
+                    thumbnail_upload = upload_pool.submit(
+                        self.try_upload_preview_file,
+                        pyclowder.files.upload_thumbnail,
+                        connector,
+                        host,
+                        secret_key,
+                        resource["id"],
+                        slidepath,
+                    )
+
+                upload = upload_pool.submit(
+                    self.try_upload_preview_file,
+                    pyclowder.files.upload_preview,
+                    connector,
+                    host,
+                    secret_key,
+                    resource["id"],
+                    slidepath,
+                    parameters={},
+                )
+
+                # add a description to every preview
+                # pyclowder.sections.upload_description(connector, host, secret_key, sectionid, {'description': description})
+
+                slide_uploads.append((frame_idx, time_idx, upload))
+
+            # Wait for the encoder job to finish
+            mp4_preview_file = os.path.join(self.tempdir, mp4_preview)
+            webm_preview_file = os.path.join(self.tempdir, webm_preview)
+            if encode_job is not None:
+                encode_job.join()
+            if decode_job is not None:
+                decode_job.join()
+            if not os.path.exists(mp4_preview_file):
+                self.logger.error("Video preview files were not created correctly!")
+                # Without the video the slides are of no use, take them away again
+                self.remove_previews(
+                    connector,
+                    host,
+                    secret_key,
+                    [upload for _, _, upload in slide_uploads if upload is not None],
+                )
+                if thumbnail_upload is not None:
+                    self.logger.warning(
+                        "Leaving the thumbnail of %s (made from the first slide) in place",
+                        resource["id"],
+                    )
+                return []
+
+            # Upload the compressed previews
+            mp4_upload = upload_pool.submit(
+                self.try_upload_preview_file,
                 pyclowder.files.upload_preview,
                 connector,
                 host,
@@ -480,8 +1764,10 @@ class VideoMetaData(Extractor):
                 mp4_preview_file,
                 parameters={},
             )
+            webm_upload = None
             if webm and os.path.exists(webm_preview_file):
-                webm_preview_id = self.try_upload_preview_file(
+                webm_upload = upload_pool.submit(
+                    self.try_upload_preview_file,
                     pyclowder.files.upload_preview,
                     connector,
                     host,
@@ -490,16 +1776,22 @@ class VideoMetaData(Extractor):
                     webm_preview_file,
                     parameters={},
                 )
-        else:
-            self.logger.error("Video preview files were not created correctly!")
-            return []
+
+            # Collect the IDs of the uploads (this raises the error of a failed upload)
+            mp4_preview_id = mp4_upload.result()
+            webm_preview_id = webm_upload.result() if webm_upload is not None else None
+            if thumbnail_upload is not None:
+                thumbnail_upload.result()
+            self.results = []
+            for frame_idx, time_idx, upload in slide_uploads:
+                previewid = upload.result() if upload is not None else None
+                self.results.append((frame_idx, time_idx, previewid))
 
         if webm:
             previews = {"mp4": mp4_preview_id, "webm": webm_preview_id}
         else:
             previews = {"mp4": mp4_preview_id}
-
-        self.results = []
+        previews["method"] = preview_method
 
         slidesmeta = {
             "nrslides": 0,
@@ -510,44 +1802,6 @@ class VideoMetaData(Extractor):
         }
         self.logger.debug("tmp results: %s", results)
 
-        for idx, (frame_idx, time_idx, slidepath) in enumerate(results):
-            # last second/frame always gets added for WebVTT but hasn't got a slidepath set
-            if not slidepath:
-                self.results.append((frame_idx, time_idx, None))
-                continue
-
-            # Create section for file (currently not used)
-            # sectionid = sections_upload(connector, host, secret_key, {'file_id': resource['id']})
-            # slidemeta = {
-            #    'section_id': sectionid,
-            # }
-            # description = "Slide %2d at %s" % (idx + 1, datetime.timedelta(milliseconds=time_idx))
-            # upload preview & associated it with the section
-            if idx == 0:
-                self.try_upload_preview_file(
-                    pyclowder.files.upload_thumbnail,
-                    connector,
-                    host,
-                    secret_key,
-                    resource["id"],
-                    slidepath,
-                )
-
-            previewid = self.try_upload_preview_file(
-                pyclowder.files.upload_preview,
-                connector,
-                host,
-                secret_key,
-                resource["id"],
-                slidepath,
-                parameters={},
-            )
-
-            # add a description to every preview
-            # pyclowder.sections.upload_description(connector, host, secret_key, sectionid, {'description': description})
-
-            self.results.append((frame_idx, time_idx, previewid))
-
         self.logger.debug("final results: %s", self.results)
 
         # first and last frame will always be in self.results
@@ -597,7 +1851,20 @@ class VideoMetaData(Extractor):
             metadata,
         )
 
-    def slide_find_advanced(self, filename, connector, resource, **settings):
+        # All done, nothing to resume anymore
+        if checkpoint_dir is not None:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+    def slide_find_advanced(
+        self,
+        filename,
+        connector,
+        resource,
+        frames_pipe=None,
+        checkpoint_dir=None,
+        checkpoint_interval=0,
+        **settings
+    ):  # pylint: disable=too-many-arguments,too-many-locals,too-many-branches,too-many-statements
         """
         Gather a list of transitions from an input video.
         The algorithm leverages motion tracking techniques and works well with unprocessed screen capture (heavy
@@ -608,6 +1875,11 @@ class VideoMetaData(Extractor):
         :param masks: list of area to mask out before doing slide transition detection
         :param connector: Not really sure (from Clowder API)
         :param resource: Also not really sure (from Clowder API)
+        :param frames_pipe: optional pipe with the frames of the video (at analysis_fps) as raw BGR frames, to use
+        instead of decoding the video
+        :param checkpoint_dir: optional directory to keep the screenshots and the progress of the detection in, so it
+        can resume from there
+        :param checkpoint_interval: number of seconds between checkpoints in checkpoint_dir
         :param trigger_ratio: the relative ratio of changed pixels that causes a trigger
         :param minimum_total_change: minimum number of pixels that must change to register a trigger (on a scale between
         0 and 1, with a default of 6%)
@@ -615,6 +1887,10 @@ class VideoMetaData(Extractor):
         :param motion_capture_averaging_time: the time over which to build up our average of the background (in seconds)
         :param msec_to_delay_screenshot: The amount of delay before taking a screenshot (good for animated slide
         transitions) in milliseconds
+        :param analysis_fps: number of frames per second that get analysed (0 for all frames)
+        :param analysis_width: width the frames are scaled down to for the analysis (0 for the full resolution)
+        :param detection_workers: number of processes to split the video over (0 for half of the cores)
+        :param opencv_threads: number of threads OpenCV may use in every detection process (0 for the OpenCV default)
         :return list with tuples of frame number, timestamp and path to screenshot of slide
         """
         options = dict(default_settings_advanced)
@@ -629,6 +1905,8 @@ class VideoMetaData(Extractor):
         minimum_slide_length = options.get("minimum_slide_length")
         motion_capture_averaging_time = options.get("motion_capture_averaging_time")
         msec_to_delay_screenshot = options.get("msec_to_delay_screenshot")
+        analysis_fps = options.get("analysis_fps")
+        analysis_width = options.get("analysis_width")
 
         cap = cv2.VideoCapture(filename)
         if not cap.isOpened():
@@ -638,12 +1916,24 @@ class VideoMetaData(Extractor):
         # Grab some basic information about the video
         width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
         height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
-        # I would like to change the sampling FPS to something like 5fps since this would mean processing a lot less
-        # frames but using cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index) is actually very slow and not worth the change
+        # Seeking with cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index) to sample the video is very slow, so we go
+        # through all frames but only grab() (which skips converting and copying the frame) the ones we don't analyse
         fps = cap.get(cv2.CAP_PROP_FPS)  # Assuming non-variable FPS
         num_frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+        cap.release()
+        # Without sampling and downscaling, the frames get analysed as they are (in BGR), like they always were.
+        # Otherwise they get analysed in grayscale, at a lower resolution.
+        grayscale = bool(analysis_fps or analysis_width)
+        if not analysis_fps or analysis_fps > fps:
+            analysis_fps = fps
+        if not analysis_width or analysis_width > width:
+            analysis_width = width
+        analysis_scale = analysis_width / float(width)
+        analysis_size = (
+            max(1, int(round(width * analysis_scale))),
+            max(1, int(round(height * analysis_scale))),
+        )
 
-        slides = []
         errors = []
 
         cur_masks = self.prepare_masks(masks, (int(height), int(width)))
@@ -654,6 +1944,9 @@ class VideoMetaData(Extractor):
         for mask in cur_masks:
             if (mask["x2"] > width) or (mask["y2"] > height):
                 errors += ["Mask is outside bounds of image!"]
+        # Analysing less than a frame per second misses short slides
+        if analysis_fps < 1:
+            errors += ["Expected an analysis_fps of at least 1 (or 0 for all frames)!"]
         # Give some reasonable bounds for the trigger ratio
         if trigger_ratio < 2 or trigger_ratio > 10:
             errors += ["Expected a trigger ratio in range from 2 to 10!"]
@@ -674,131 +1967,243 @@ class VideoMetaData(Extractor):
                 self.logger.error("Algorithm parameter error: %s", error)
             return []
 
-        # Set lower bound on our pixel change average
-        mask_area = 0
-        for mask in cur_masks:
-            mask_area += (mask["x2"] - mask["x1"]) * (mask["y2"] - mask["y1"])
+        # The masks at the resolution of the analysis
+        analysis_masks = [
+            dict(
+                (key, int(round(mask[key] * analysis_scale)))
+                for key in ["x1", "x2", "y1", "y2"]
+            )
+            for mask in cur_masks
+        ]
+
+        # Combine the masks once into a single image to AND the frames with (255 is kept, 0 is masked out)
+        analysis_mask = None
+        if analysis_masks:
+            analysis_mask = np.full(
+                (analysis_size[1], analysis_size[0]), 255, dtype=np.uint8
+            )
+            for mask in analysis_masks:
+                analysis_mask[mask["y1"] : mask["y2"], mask["x1"] : mask["x2"]] = 0
+
+        # Set lower bound on our pixel change average (in pixels of the analysis resolution)
+        if analysis_mask is not None:
+            unmasked_area = cv2.countNonZero(analysis_mask)
+            if not grayscale:
+                analysis_mask = cv2.merge([analysis_mask] * 3)
+        else:
+            unmasked_area = analysis_size[0] * analysis_size[1]
 
-        min_pixel_change_av = (minimum_total_change / trigger_ratio) * (
-            (width * height) - mask_area
-        )
+        min_pixel_change_av = (minimum_total_change / trigger_ratio) * unmasked_area
+
+        # Frames from the pipe come at the analysis rate already, so the frames get counted at that rate
+        if frames_pipe is not None:
+            stream_fps = analysis_fps
+        else:
+            stream_fps = fps
+        stream_frames = num_frames * stream_fps / fps
 
         # Set the number of frames for the minimum length of a slide
-        minimum_slide_length_in_frames = int(round(minimum_slide_length * fps))
+        minimum_slide_length_in_frames = int(round(minimum_slide_length * stream_fps))
 
-        #  Allocate space for our average of the changes of the frames in the last averaging_time seconds
-        averaging_frames = int(motion_capture_averaging_time * fps)
-        av_array = np.zeros(averaging_frames, dtype=int)
-
-        # Set up the motion capture algorithm to learn over our set averaging time and output B/W images
-        fgbg = cv2.createBackgroundSubtractorKNN(
-            history=averaging_frames, detectShadows=False
-        )
+        #  The number of analysed frames in the last averaging_time seconds that we average the changes over
+        averaging_frames = max(1, int(motion_capture_averaging_time * analysis_fps))
 
         # Set the number of frames we can safely ignore after we have a trigger,which is the minimum
         # slide length adjusted for our averaging_frames frames so that we have the correct average and bg memory
-        ignore_frames = (minimum_slide_length * fps) - averaging_frames
-
-        frame_index = 0
-        previous_trigger_frame = 0
-        average = 0.0
-        percent_processed = 0
-        while frame_index < num_frames:
-            ret, frame = cap.read()
-
-            if not ret:
-                break
-
-            orig_frame = np.copy(frame)
-
-            # Apply our mask
-            try:
-                for mask in cur_masks:
-                    frame[mask["y1"] : mask["y2"], mask["x1"] : mask["x2"], 0:3] = 0
-            except (KeyError, ValueError) as err:
-                self.logger.error("Failed to apply mask %s: %s", mask, err)
+        ignore_frames = minimum_slide_length * stream_fps - int(
+            motion_capture_averaging_time * stream_fps
+        )
 
-            # Check to we are in the region where a slide will never be extracted (due to
-            # min_slide_length). If so, don't do any of the hard work.
+        # The number of analysed frames the background model learns over
+        model_history = knn_history(motion_capture_averaging_time, analysis_fps, fps)
+
+        detection = {
+            "width": int(width),
+            "height": int(height),
+            "fps": stream_fps,
+            "num_frames": stream_frames,
+            "analysis_fps": analysis_fps,
+            "analysis_size": analysis_size,
+            "analysis_mask": analysis_mask,
+            "trigger_ratio": trigger_ratio,
+            "min_pixel_change_av": min_pixel_change_av,
+            "minimum_slide_length_in_frames": minimum_slide_length_in_frames,
+            "averaging_frames": averaging_frames,
+            "model_warmup_frames": int(
+                np.ceil(model_history * stream_fps / float(analysis_fps))
+            ),
+            "average_warmup_frames": int(
+                round(motion_capture_averaging_time * stream_fps)
+            ),
+            "ignore_frames": ignore_frames,
+            "msec_to_delay_screenshot": msec_to_delay_screenshot,
+            "grayscale": grayscale,
+            "knn_history": model_history,
+            "knn_dist2_threshold": (
+                KNN_DIST2_THRESHOLD_GRAY if grayscale else KNN_DIST2_THRESHOLD_BGR
+            ),
+            "opencv_threads": options.get("opencv_threads"),
+            "checkpoint_interval": checkpoint_interval,
+        }
 
-            if (
-                frame_index > (previous_trigger_frame + ignore_frames)
-                or frame_index == 0
-            ):
-                # Apply the mask and count the white pixels
-                fgmask = fgbg.apply(frame)
-                # If you want to see what the algorithm is looking at, uncomment the below
-                # cv2.imshow('frame', fgmask)
-                # if cv2.waitKey(1) & 0xFF == ord('q'):
-                # break
+        # With checkpoints, the screenshots are kept with them until everything is done
+        if checkpoint_dir is not None:
+            output_dir = checkpoint_dir
+        else:
+            output_dir = self.tempdir
+
+        def segment_checkpoint(start_frame, end_frame):
+            """Path of the checkpoint of the detection of a segment"""
+            if checkpoint_dir is None:
+                return None
+            return os.path.join(
+                checkpoint_dir, "segment%d-%d.json" % (start_frame, end_frame)
+            )
 
-                # Count the changed pixels (based on the learned background)
-                whites = int(cv2.countNonZero(fgmask))
+        # Split the video in segments that get processed in parallel. Every segment also processes the warm up before
+        # it (the history of the background model and motion_capture_averaging_time), so keep them at least 10 times
+        # the minimum slide length to keep that overhead small.
+        # The frames from a pipe can only be read in one go.
+        detection_workers = options.get("detection_workers")
+        if not detection_workers:
+            detection_workers = max(1, multiprocessing.cpu_count() // 2)
+        if frames_pipe is not None:
+            detection_workers = 1
+        segment_frames = max(
+            int(np.ceil(stream_frames / detection_workers)),
+            10 * minimum_slide_length_in_frames,
+            1,
+        )
+        segments = [
+            (start_frame, min(start_frame + segment_frames, stream_frames))
+            for start_frame in range(0, int(stream_frames), segment_frames)
+        ]
+
+        def report_progress(frames_processed):
+            """Let people know how far along we are"""
+            percent_processed = int(100 * frames_processed / stream_frames)
+            self.logger.debug("Processed %03d %%", percent_processed)
+            # Also send to extractor log
+            if percent_processed % 10 == 0 or percent_processed == 99:
+                connector.message_process(
+                    resource, "Processed %03d %%" % percent_processed
+                )
 
-                # Check if we have a trigger
-                if (
-                    frame_index - previous_trigger_frame
-                ) > minimum_slide_length_in_frames or frame_index == 0:
-                    if average > min_pixel_change_av:
-                        proxy_average = average
-                    else:
-                        proxy_average = min_pixel_change_av
-
-                    if (whites > trigger_ratio * proxy_average) or frame_index == 0:
-                        # Grab the slide
-                        timestamp = cap.get(cv2.CAP_PROP_POS_MSEC)
-                        self.logger.debug("Found slide transition at %s", timestamp)
-
-                        # Set the path now, but write the image later
-                        slide_path = os.path.join(
-                            self.tempdir, "slide%05d.webp" % (len(slides) + 1)
-                        )
-
-                        slides.append((frame_index, timestamp, slide_path))
-
-                        previous_trigger_frame = frame_index
-                        # Restart the averaging process
-                        average = 0.0
-                        av_array[:] = 0
-
-                # Update our average and the associated array. Since we know that the average is restarted after every
-                # trigger things are sequential and it is safe to use modulo here.
-                if previous_trigger_frame != frame_index:
-                    # First remove the value of the previous entry from the average
-                    average -= av_array[frame_index % averaging_frames] / float(
-                        averaging_frames
+        if frames_pipe is not None:
+            self.logger.debug("Finding slides in the frames of the preview encoder")
+            segment_results = [
+                detect_slide_transitions(
+                    RawVideoReader(frames_pipe, int(width), int(height), stream_fps),
+                    output_dir,
+                    0,
+                    stream_frames,
+                    detection,
+                    report_progress,
+                    segment_checkpoint(0, stream_frames),
+                )
+            ]
+            # When the encoder fails, we don't get all frames
+            if segment_results[0][1] < 0.95 * stream_frames:
+                self.logger.warning(
+                    "Only got %d of %d frames from the preview encoder, finding the slides in the video instead",
+                    segment_results[0][1],
+                    stream_frames,
+                )
+                for _, _, screenshot_path in segment_results[0][0]:
+                    if os.path.exists(screenshot_path):
+                        os.remove(screenshot_path)
+                if checkpoint_dir is not None:
+                    os.remove(segment_checkpoint(0, stream_frames))
+                return self.slide_find_advanced(
+                    filename,
+                    connector,
+                    resource,
+                    checkpoint_dir=checkpoint_dir,
+                    checkpoint_interval=checkpoint_interval,
+                    **settings
+                )
+        elif len(segments) == 1:
+            segment_results = [
+                detect_slide_transitions(
+                    filename,
+                    output_dir,
+                    0,
+                    stream_frames,
+                    detection,
+                    report_progress,
+                    segment_checkpoint(0, stream_frames),
+                )
+            ]
+        else:
+            self.logger.debug(
+                "Finding slides in %d segments with %d processes",
+                len(segments),
+                min(detection_workers, len(segments)),
+            )
+            with multiprocessing.Pool(
+                processes=min(detection_workers, len(segments))
+            ) as pool:
+                jobs = [
+                    pool.apply_async(
+                        detect_slide_transitions,
+                        (
+                            filename,
+                            output_dir,
+                            start_frame,
+                            end_frame,
+                            detection,
+                            None,
+                            segment_checkpoint(start_frame, end_frame),
+                        ),
                     )
-                    # Add the new value to the array
-                    av_array[frame_index % averaging_frames] = whites
-                    # Update the average
-                    average += av_array[frame_index % averaging_frames] / float(
-                        averaging_frames
+                    for start_frame, end_frame in segments
+                ]
+                segment_results = []
+                for job, (_, end_frame) in zip(jobs, segments):
+                    segment_results.append(job.get())
+                    report_progress(end_frame)
+
+        # Join the transitions of all segments, a transition right after the join can be too close to the last one of
+        # the previous segment
+        slides = []
+        for segment_slides, frame_index, final_timestamp in segment_results:
+            for slide_frame_index, timestamp, screenshot_path in segment_slides:
+                if (
+                    slides
+                    and slide_frame_index - slides[-1][0]
+                    <= minimum_slide_length_in_frames
+                ):
+                    self.logger.debug(
+                        "Dropping slide transition at %s, it is too close to the previous one",
+                        timestamp,
                     )
+                    if checkpoint_dir is None:
+                        os.remove(screenshot_path)
+                    continue
+
+                slide_path = os.path.join(
+                    self.tempdir, "slide%05d.webp" % (len(slides) + 1)
+                )
+                # The checkpoints still need their screenshots
+                if checkpoint_dir is not None:
+                    shutil.copyfile(screenshot_path, slide_path)
+                else:
+                    os.rename(screenshot_path, slide_path)
+                slides.append((slide_frame_index, timestamp, slide_path))
 
-            # Let people know how far along we are
-            frame_index += 1
-            if (frame_index % round(num_frames / 100.0)) == 0:
-                percent_processed += 1
-                self.logger.debug("Processed %03d %%", percent_processed)
-                # Also send to extractor log
-                if percent_processed % 10 == 0 or percent_processed == 99:
-                    connector.message_process(resource, "Processed %03d %%" % percent_processed)
-
-        # Now that we know all the transitions, grab the slide image with a configurable offset
-        final_timestamp = cap.get(cv2.CAP_PROP_POS_MSEC)
-        for slide in slides:
-            # Set the time position of the slide for the grab
-            cap.set(cv2.CAP_PROP_POS_MSEC, slide[1] + msec_to_delay_screenshot)
-            # Grab the image
-            _, frame = cap.read()
-            # if it comes back blank, just use an empty white image
-            if frame is None or frame.size == 0:
-                frame = np.ones((int(height), int(width), 3), np.uint8) * 255
-            # Save the image
-            cv2.imwrite(slide[2], frame, [cv2.IMWRITE_WEBP_QUALITY, 80])
         # Add am empty slide to hold the terminating timestamp
         slides.append((frame_index, final_timestamp, None))
-        cap.release()
+
+        # Number the frames as in the video rather than as in the pipe
+        if stream_fps != fps:
+            slides = [
+                (
+                    int(round(slide_frame_index * fps / stream_fps)),
+                    timestamp,
+                    slide_path,
+                )
+                for slide_frame_index, timestamp, slide_path in slides
+            ]
 
         return slides
 